@@ -0,0 +1,188 @@
+import os
+import shutil
+
+import numpy as np
+import yaml
+from scipy.sparse import csr_matrix
+
+from py.sim_metrics import prepare_vectors
+from py.utils import DISTANCE_METRIC
+
+BLOCK_SIZE = 4096
+
+
+def index_dir(file_name, ds_name):
+    return "/app/data/output/{}.ivf/{}".format(file_name, ds_name)
+
+
+def default_n_lists(count):
+    return int(max(1, min(count, round(4 * np.sqrt(count)))))
+
+
+def assign(vectors, centroids):
+    # vectors and centroids are unit length, so the nearest centroid is the one with the highest dot product
+    lists = np.empty(len(vectors), dtype=np.int64)
+    scores = np.empty(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), BLOCK_SIZE):
+        sims = np.dot(vectors[start:start + BLOCK_SIZE], centroids.T)
+        lists[start:start + len(sims)] = np.argmax(sims, axis=1)
+        scores[start:start + len(sims)] = sims[np.arange(len(sims)), lists[start:start + len(sims)]]
+    return lists, scores
+
+
+def spherical_kmeans(vectors, n_lists, iterations, seed=0):
+    rng = np.random.RandomState(seed)
+    centroids = np.array(vectors[np.sort(rng.choice(len(vectors), n_lists, replace=False))])
+    lists = None
+    for iteration in range(iterations):
+        new_lists, scores = assign(vectors, centroids)
+        if lists is not None and np.array_equal(new_lists, lists):
+            return centroids, iteration
+        lists = new_lists
+        members = csr_matrix((np.ones(len(lists), dtype=np.float32), (lists, np.arange(len(lists)))),
+                             shape=(n_lists, len(vectors)))
+        centroids = prepare_vectors(members.dot(vectors), DISTANCE_METRIC.COSINE)
+        # empty lists restart from the vectors that are furthest from their own centroid
+        empty = np.flatnonzero(np.bincount(lists, minlength=n_lists) == 0)
+        if len(empty):
+            centroids[empty] = vectors[np.sort(np.argsort(scores)[:len(empty)])]
+    return centroids, iterations
+
+
+def merge_top_k(best_index, best_sims, index, sims, k):
+    candidate_index = np.hstack([best_index, np.broadcast_to(index, sims.shape)])
+    candidate_sims = np.hstack([best_sims, sims])
+    rows = np.arange(len(candidate_sims))[:, np.newaxis]
+    keep = np.argpartition(-candidate_sims, k - 1, axis=1)[:, :k]
+    return candidate_index[rows, keep], candidate_sims[rows, keep]
+
+
+def recall_at_k(found_sims, exact_sims):
+    # anything scoring as high as the k-th true neighbour is a hit, so texts with equal vectors are not misses
+    valid = ~np.isnan(exact_sims)
+    threshold = np.where(valid, exact_sims, np.inf).min(axis=1)[:, np.newaxis] - 1e-6
+    hits = np.minimum(np.count_nonzero(found_sims >= threshold, axis=1), valid.sum(axis=1))
+    return float(hits.sum() / valid.sum()) if valid.any() else 1.0
+
+
+def build_index(prepared_file, ids, directory, n_lists, iterations, train_size, settings):
+    # vectors are stored grouped by list so that probing a list reads one contiguous slice
+    vectors = np.load(prepared_file, mmap_mode='r')
+    rng = np.random.RandomState(0)
+    train = np.sort(rng.choice(len(vectors), min(train_size, len(vectors)), replace=False))
+    centroids, iterations = spherical_kmeans(np.array(vectors[train]), min(n_lists, len(train)), iterations)
+    lists, _ = assign(vectors, centroids)
+    order = np.argsort(lists, kind='stable')
+    build_dir = "{}.tmp".format(directory)
+    shutil.rmtree(build_dir, ignore_errors=True)
+    os.makedirs(build_dir)
+    np.save("{}/centroids.npy".format(build_dir), centroids)
+    np.save("{}/offsets.npy".format(build_dir),
+            np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=len(centroids)))]).astype(np.int64))
+    np.save("{}/rows.npy".format(build_dir), order)
+    np.save("{}/ids.npy".format(build_dir), ids)
+    ordered = np.lib.format.open_memmap("{}/vectors.npy".format(build_dir), mode='w+', dtype=np.float32,
+                                        shape=vectors.shape)
+    for start in range(0, len(order), BLOCK_SIZE):
+        ordered[start:start + BLOCK_SIZE] = vectors[order[start:start + BLOCK_SIZE]]
+    ordered.flush()
+    del ordered
+    settings = dict(settings, n_lists=len(centroids), count=len(vectors), iterations=iterations)
+    with open("{}/index.yml".format(build_dir), "w") as out_file:
+        yaml.dump(settings, out_file, default_flow_style=False)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(build_dir, directory)
+    return IVFIndex.load(directory)
+
+
+class IVFIndex(object):
+
+    def __init__(self, centroids, offsets, rows, vectors, ids, settings):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.rows = rows
+        self.vectors = vectors
+        self.ids = ids
+        self.settings = settings
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    @property
+    def distance_metric(self):
+        return DISTANCE_METRIC[self.settings["distance_metric"].upper()]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def vectors_of(self, rows):
+        positions = np.empty(len(self.rows), dtype=np.int64)
+        positions[self.rows] = np.arange(len(self.rows))
+        return np.array(self.vectors[positions[rows]])
+
+    def probe(self, queries, n_probe):
+        if n_probe >= self.n_lists:
+            return np.broadcast_to(np.arange(self.n_lists), (len(queries), self.n_lists))
+        return np.argpartition(-np.dot(queries, self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+
+    def search(self, queries, k, n_probe, exclude=None):
+        # queries are grouped by the lists they probe so each list is scored against all of its queries at once
+        best_index = np.full((len(queries), k), -1, dtype=np.int64)
+        best_sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        if not len(queries):
+            return self.sorted(best_index, best_sims)
+        probes = self.probe(queries, n_probe)
+        query_rows = np.repeat(np.arange(len(queries)), probes.shape[1])
+        order = np.argsort(probes.ravel(), kind='stable')
+        probes, query_rows = probes.ravel()[order], query_rows[order]
+        starts = np.flatnonzero(np.r_[True, probes[1:] != probes[:-1]])
+        for list_id, members in zip(probes[starts], np.split(query_rows, starts[1:])):
+            start, end = self.offsets[list_id], self.offsets[list_id + 1]
+            if start < end:
+                best_index[members], best_sims[members] = self.score(queries[members], start, end, k,
+                                                                     best_index[members], best_sims[members],
+                                                                     None if exclude is None else exclude[members])
+        return self.sorted(best_index, best_sims)
+
+    def exact_search(self, queries, k, exclude=None):
+        best_index = np.full((len(queries), k), -1, dtype=np.int64)
+        best_sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for start in range(0, len(self.rows), BLOCK_SIZE):
+            best_index, best_sims = self.score(queries, start, min(start + BLOCK_SIZE, len(self.rows)), k,
+                                               best_index, best_sims, exclude)
+        return self.sorted(best_index, best_sims)
+
+    def score(self, queries, start, end, k, best_index, best_sims, exclude):
+        sims = np.dot(queries, self.vectors[start:end].T)
+        rows = self.rows[start:end]
+        if exclude is not None:
+            sims[exclude[:, np.newaxis] == rows] = -np.inf
+        return merge_top_k(best_index, best_sims, rows, sims, k)
+
+    @staticmethod
+    def sorted(best_index, best_sims):
+        rows = np.arange(len(best_sims))[:, np.newaxis]
+        order = np.argsort(-best_sims, axis=1, kind='stable')
+        best_index, best_sims = best_index[rows, order], best_sims[rows, order]
+        # lists holding fewer than k vectors leave the rest of a row empty
+        best_index[np.isneginf(best_sims)] = -1
+        best_sims[np.isneginf(best_sims)] = np.nan
+        return best_index, best_sims
+
+    def save_settings(self, directory):
+        with open("{}/index.yml".format(directory), "w") as out_file:
+            yaml.dump(self.settings, out_file, default_flow_style=False)
+
+    @classmethod
+    def load(cls, directory):
+        def load_array(name):
+            return np.load("{}/{}.npy".format(directory, name), mmap_mode='r')
+        with open("{}/index.yml".format(directory)) as in_file:
+            settings = yaml.safe_load(in_file)
+        return cls(np.array(load_array("centroids")),
+                   np.array(load_array("offsets")),
+                   load_array("rows"),
+                   load_array("vectors"),
+                   load_array("ids"),
+                   settings)
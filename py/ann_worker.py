@@ -0,0 +1,15 @@
+from py.ann_index import IVFIndex
+
+index: IVFIndex
+
+
+def init_worker(directory):
+    global index
+    index = IVFIndex.load(directory)
+
+
+def search(task):
+    global index
+    offset, queries, k, n_probe, exclude = task
+    found, sims = index.search(queries, k, n_probe, exclude)
+    return offset, found, sims
@@ -0,0 +1,144 @@
+import os
+import shutil
+import warnings
+from hashlib import blake2b
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+def token_hash(token):
+    return int.from_bytes(blake2b(token.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class Vocabulary(object):
+    # token -> id map stored as sorted 64 bit token hashes so that it can be memory mapped and shared
+
+    def __init__(self, hashes, ids):
+        self.hashes = hashes
+        self.ids = ids
+
+    @classmethod
+    def from_token2id(cls, token2id):
+        hashes = np.fromiter((token_hash(t) for t in token2id), dtype=np.uint64, count=len(token2id))
+        ids = np.fromiter(token2id.values(), dtype=np.int64, count=len(token2id))
+        order = np.argsort(hashes)
+        hashes, ids = hashes[order], ids[order]
+        if np.any(hashes[1:] == hashes[:-1]):
+            raise Exception("Two tokens in the dictionary share a hash")
+        return cls(hashes, ids)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def lookup(self, tokens):
+        hashes = np.fromiter((token_hash(t) for t in tokens), dtype=np.uint64, count=len(tokens))
+        positions = np.minimum(np.searchsorted(self.hashes, hashes), max(len(self.hashes) - 1, 0))
+        found = self.hashes[positions] == hashes if len(self.hashes) else np.zeros(len(hashes), dtype=bool)
+        return np.where(found, self.ids[positions], -1)
+
+
+class BatchProjector(object):
+
+    def __init__(self, vocabulary, u, s, weights=None, scaled=False):
+        self.vocabulary = vocabulary
+        self.u = u
+        self.s = s
+        self.weights = weights
+        self.scale = (1.0 / s).astype(np.float32) if scaled else None
+
+    @property
+    def dimensions(self):
+        return self.u.shape[1]
+
+    def term_matrix(self, documents):
+        lengths = np.fromiter((len(d) for d in documents), dtype=np.int64, count=len(documents))
+        ids = self.vocabulary.lookup([w for document in documents for w in document])
+        known = ids >= 0
+        rows = np.repeat(np.arange(len(documents)), lengths)[known]
+        matrix = csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, ids[known])),
+                            shape=(len(documents), self.u.shape[0]))
+        matrix.sum_duplicates()
+        return matrix
+
+    def weight(self, matrix):
+        # the same log entropy weighting and unit length normalization gensim applies when the space is built
+        matrix.data = np.log1p(matrix.data) * self.weights[matrix.indices]
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        matrix.data /= np.repeat(norms, np.diff(matrix.indptr)).astype(np.float32)
+        return matrix
+
+    def project(self, documents):
+        matrix = self.term_matrix(documents)
+        if self.weights is not None:
+            matrix = self.weight(matrix)
+        vectors = np.asarray(matrix.dot(self.u), dtype=np.float32)
+        if self.scale is not None:
+            vectors *= self.scale
+        return vectors
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.save("{}/u.npy".format(directory), self.u)
+        np.save("{}/s.npy".format(directory), self.s)
+        np.save("{}/vocabulary_hashes.npy".format(directory), self.vocabulary.hashes)
+        np.save("{}/vocabulary_ids.npy".format(directory), self.vocabulary.ids)
+        if self.weights is not None:
+            np.save("{}/weights.npy".format(directory), self.weights)
+
+    @classmethod
+    def load(cls, directory, scaled=False):
+        # every array is memory mapped, so processes that load the same directory share one copy in the page cache
+        def load_array(name):
+            return np.load("{}/{}.npy".format(directory, name), mmap_mode='r')
+        if os.path.isfile("{}/weights.npy".format(directory)):
+            weights = load_array("weights")
+        else:
+            weights = None
+        return cls(Vocabulary(load_array("vocabulary_hashes"), load_array("vocabulary_ids")),
+                   load_array("u"),
+                   np.array(load_array("s")),
+                   weights,
+                   scaled)
+
+
+def compiled_space_dir(space_name, model_name="lsi"):
+    return "/app/data/spaces/{}/{}.compiled".format(space_name, model_name)
+
+
+def load_batch_projector(space_name, model_name="lsi", scaled=False):
+    # gensim is only imported here so that jobs using a compiled space never pay for it
+    from gensim.corpora import Dictionary
+    from gensim.models import LogEntropyModel, LsiModel
+    dictionary = Dictionary.load("/app/data/spaces/{}/dictionary".format(space_name))
+    model = LsiModel.load("/app/data/spaces/{}/{}".format(space_name, model_name))
+    try:
+        log_entropy = LogEntropyModel.load("/app/data/spaces/{}/log_entropy".format(space_name))
+        weights = np.zeros(model.projection.u.shape[0], dtype=np.float32)
+        for term_id, weight in log_entropy.entr.items():
+            weights[term_id] = weight
+    except (IOError, OSError):
+        warnings.warn("No log entropy model saved for space {}, projecting raw term counts".format(space_name))
+        weights = None
+    return BatchProjector(Vocabulary.from_token2id(dictionary.token2id),
+                          np.asarray(model.projection.u, dtype=np.float32),
+                          np.asarray(model.projection.s, dtype=np.float32),
+                          weights,
+                          scaled)
+
+
+def compile_space(space_name, model_name="lsi"):
+    space_dir = compiled_space_dir(space_name, model_name)
+    # build next to the old copy and swap it in so readers never see a half written space
+    build_dir = "{}.tmp".format(space_dir)
+    shutil.rmtree(build_dir, ignore_errors=True)
+    load_batch_projector(space_name, model_name).save(build_dir)
+    shutil.copy("/app/data/spaces/{}/space_config.yml".format(space_name), build_dir)
+    shutil.rmtree(space_dir, ignore_errors=True)
+    os.rename(build_dir, space_dir)
+    return space_dir
+
+
+def load_compiled_space(space_name, model_name="lsi", scaled=False):
+    return BatchProjector.load(compiled_space_dir(space_name, model_name), scaled)
@@ -0,0 +1,218 @@
+import argparse
+import importlib
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from shutil import rmtree
+
+import numpy as np
+import yaml
+
+BENCH_DIR = "/app/data/bench"
+RESULTS_FILE = "{}/results.json".format(BENCH_DIR)
+# above this many texts a full matrix does not fit on disk, so only the top k neighbours are kept
+MATRIX_LIMIT = 20000
+TOP_K = 10
+
+TASKS = {
+    "CREATE": ("py.space_creator", "Creator"),
+    "PROJECT": ("py.projector", "Projector"),
+    "CALCULATE": ("py.sim_calculator", "SimCalculator"),
+}
+
+
+def vocabulary(size, rng):
+    syllables = np.array([c + v for c in "bcdfghjklmnprstvwz" for v in "aeiou"])
+    lengths = rng.randint(1, 4, size * 2)
+    words = np.unique(["".join(rng.choice(syllables, n)) for n in lengths])
+    return rng.permutation(words)[:size]
+
+
+def write_texts(file_name, count, min_words, max_words, numbered, seed=0, vocabulary_size=50000):
+    # word frequencies follow Zipf's law so that the dictionary, the singleton filter and the
+    # sparsity of the term matrix look like those of a real corpus
+    if os.path.isfile(file_name):
+        return
+    rng = np.random.RandomState(seed)
+    words = vocabulary(vocabulary_size, rng)
+    probabilities = 1.0 / np.arange(1, len(words) + 1) ** 1.07
+    probabilities /= probabilities.sum()
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name + ".tmp", "w") as out_file:
+        for offset in range(0, count, 10000):
+            lengths = rng.randint(min_words, max_words + 1, min(10000, count - offset))
+            tokens = rng.choice(words, lengths.sum(), p=probabilities)
+            ends = np.cumsum(lengths)
+            lines = (" ".join(tokens[end - length:end]) for end, length in zip(ends, lengths))
+            if numbered:
+                out_file.writelines("{}\t{}\n".format(offset + i, line) for i, line in enumerate(lines))
+            else:
+                out_file.writelines(line + "\n" for line in lines)
+    os.rename(file_name + ".tmp", file_name)
+
+
+def write_config(file_name, tasks, cores):
+    with open(file_name, "w") as out_file:
+        yaml.dump({"tasks": tasks, "options": {"cores": cores}}, out_file, default_flow_style=False)
+    return os.path.relpath(file_name, "/app/data")
+
+
+def create_config(space, dimensions, corpus, args):
+    return {"type": "create_space",
+            "options": {"space": space,
+                        "dimensions": dimensions,
+                        "stem": False,
+                        "case_sensitive": False,
+                        "remove": ["punctuation", "singletons"],
+                        "decomposition": args.decomposition},
+            "from": {"document_scope": "line", "files": [corpus]}}
+
+
+def calculate_config(space, texts, output_file, count):
+    output = {"format": "H5", "file_name": output_file, "ds_name": "bench"}
+    if count > MATRIX_LIMIT:
+        output.update({"mode": "top_k", "k": TOP_K})
+    return {"type": "calculate_similarity",
+            "options": {"space": space, "distance_metric": "cosine"},
+            "from": {"files": [texts], "pairs": "all", "numbered": True},
+            "output": output}
+
+
+def run_stage(config_file, index, result_file):
+    # each stage is run in a fresh interpreter so that ru_maxrss is the peak of that stage alone
+    os.environ["CONFIG_FILE"] = config_file
+    from py.configurator import Config
+    cfg = Config()
+    os.makedirs(cfg.temp_dir)
+    task = cfg.tasks[index]
+    module, name = TASKS[task.type.name]
+    start_time = datetime.now()
+    t = getattr(importlib.import_module(module), name)(task, start_time)
+    try:
+        start = time.time()
+        t.main()
+        seconds = time.time() - start
+    finally:
+        rmtree(cfg.temp_dir)
+    with open(result_file, "w") as out_file:
+        json.dump({"seconds": seconds,
+                   "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                   "workers_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}, out_file)
+
+
+def measure(stage, config_file, index, items, **case):
+    with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+        process = subprocess.run([sys.executable, "-m", "py.benchmark", "stage", config_file, str(index),
+                                  result_file.name],
+                                 stdout=subprocess.DEVNULL)
+        if process.returncode != 0:
+            raise Exception("The {} stage of {} failed".format(stage, case))
+        with open(result_file.name) as in_file:
+            result = json.load(in_file)
+    result.update(case)
+    result.update({"stage": stage, "items": items, "items_per_second": items / max(result["seconds"], 1e-9)})
+    print("{stage:<10}{dimensions:>6d} dims{texts:>10d} texts{seconds:>10.2f}s{items_per_second:>14.0f}/s"
+          "{peak_rss_mb:>10.0f}MB".format(**result))
+    return result
+
+
+def run(args):
+    os.makedirs(BENCH_DIR, exist_ok=True)
+    corpus = "{}/corpus_{}.txt".format(BENCH_DIR, args.documents)
+    write_texts(corpus, args.documents, 40, 120, numbered=False, seed=1)
+    results = []
+    for dimensions in args.dims:
+        space = "bench_{}".format(dimensions)
+        config = write_config("{}/create_{}.yml".format(BENCH_DIR, dimensions),
+                              [create_config(space, dimensions, os.path.relpath(corpus, "/app/data"), args)],
+                              args.cores)
+        results.append(measure("create", config, 0, args.documents, dimensions=dimensions, texts=0))
+        for count in args.sizes:
+            texts = "{}/texts_{}.txt".format(BENCH_DIR, count)
+            write_texts(texts, count, 3, 12, numbered=True, seed=2)
+            output_file = "bench_{}_{}.h5".format(dimensions, count)
+            if os.path.isfile("/app/data/output/{}".format(output_file)):
+                os.remove("/app/data/output/{}".format(output_file))
+            config = write_config("{}/calculate_{}_{}.yml".format(BENCH_DIR, dimensions, count),
+                                  [calculate_config(space, os.path.relpath(texts, "/app/data"), output_file, count)],
+                                  args.cores)
+            # the calculate task queues its projection first, so the two run as separate stages
+            results.append(measure("project", config, 0, count, dimensions=dimensions, texts=count))
+            # top k scores every row in full, a matrix of all pairs only the upper triangle
+            if count > MATRIX_LIMIT:
+                results.append(measure("calculate", config, 1, count * (count - 1), dimensions=dimensions,
+                                       texts=count, mode="top_k"))
+            else:
+                results.append(measure("calculate", config, 1, count * (count - 1) // 2, dimensions=dimensions,
+                                       texts=count, mode="matrix"))
+            if not args.keep:
+                os.remove("/app/data/output/{}".format(output_file))
+    with open(args.output, "w") as out_file:
+        json.dump({"created": datetime.now().isoformat(),
+                   "host": platform.node(),
+                   "cpu_count": os.cpu_count(),
+                   "cores": args.cores,
+                   "results": results}, out_file, indent=2)
+    print("Saved results to {}".format(args.output))
+
+
+def compare(args):
+    with open(args.baseline) as in_file:
+        baseline = {(r["stage"], r["dimensions"], r["texts"]): r for r in json.load(in_file)["results"]}
+    with open(args.current) as in_file:
+        current = json.load(in_file)["results"]
+    regressions = 0
+    print("{:<10}{:>6}{:>10}{:>12}{:>12}{:>9}{:>12}".format("stage", "dims", "texts", "before", "after", "change",
+                                                           "rss change"))
+    for result in current:
+        old = baseline.get((result["stage"], result["dimensions"], result["texts"]))
+        if old is None:
+            continue
+        change = result["seconds"] / max(old["seconds"], 1e-9) - 1
+        rss_change = result["peak_rss_mb"] / max(old["peak_rss_mb"], 1e-9) - 1
+        regressed = change > args.threshold or rss_change > args.threshold
+        regressions += regressed
+        print("{:<10}{:>6d}{:>10d}{:>11.2f}s{:>11.2f}s{:>+9.1%}{:>+12.1%}{}".format(
+            result["stage"], result["dimensions"], result["texts"], old["seconds"], result["seconds"], change,
+            rss_change, "  REGRESSION" if regressed else ""))
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark space creation, projection and similarity calculation "
+                                                 "on a synthetic corpus")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    run_parser.add_argument("--dims", type=int, nargs="+", default=[100, 300, 500])
+    run_parser.add_argument("--documents", type=int, default=20000)
+    run_parser.add_argument("--cores", type=int, default=max(os.cpu_count() - 1, 1))
+    run_parser.add_argument("--decomposition", default="gensim")
+    run_parser.add_argument("--output", default=RESULTS_FILE)
+    run_parser.add_argument("--keep", action="store_true")
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current", nargs="?", default=RESULTS_FILE)
+    compare_parser.add_argument("--threshold", type=float, default=0.1)
+    stage_parser = commands.add_parser("stage")
+    stage_parser.add_argument("config_file")
+    stage_parser.add_argument("index", type=int)
+    stage_parser.add_argument("result_file")
+    args = parser.parse_args()
+    if args.command == "compare":
+        sys.exit(compare(args))
+    elif args.command == "stage":
+        run_stage(args.config_file, args.index, args.result_file)
+    elif args.command == "run":
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
+import copy
 import multiprocessing as mp
 import os
 import warnings
-from typing import List, Optional, Text
+from typing import List, Optional, Text, Union
 from uuid import uuid4
 
 import yaml
@@ -88,15 +89,61 @@ class SpaceSettings(object):
                 data['stopwords'] = False
             yaml.dump(data, out_file)
 
+    def cleaning_key(self):
+        # spaces with the same key turn a text into the same tokens
+        return (self.case_sensitive, self.remove_punctuation, self.remove_numbers, self.stem,
+                tuple(self.stopwords) if self.stopwords else None)
+
+
+def space_names_of(task_settings):
+    try:
+        space_names = task_settings["options"]["space"]
+    except KeyError:
+        raise Exception("A semantic space must be specified.")
+    if isinstance(space_names, str):
+        return [space_names]
+    if not space_names or len(set(space_names)) != len(space_names):
+        raise Exception("The list of semantic spaces must not be empty or repeat a space")
+    return space_names
+
+
+def ds_names_of(task_settings, space_names, warning):
+    # a single space keeps the plain ds_name, several spaces get it suffixed with the name of the space
+    try:
+        ds_names = task_settings["output"]["ds_name"]
+    except KeyError:
+        ds_names = 'sim'
+        warnings.warn(warning)
+    if not isinstance(ds_names, str):
+        if len(ds_names) != len(space_names) or len(set(ds_names)) != len(ds_names):
+            raise Exception("A list of ds_names must name each space once")
+        return ds_names
+    if len(space_names) == 1:
+        return [ds_names]
+    return ["{}_{}".format(ds_names, space_name) for space_name in space_names]
+
+
+def space_file_name(file_name, space_name):
+    directory, base = os.path.split(file_name)
+    stem, extension = os.path.splitext(base)
+    if extension == ".gz":
+        stem, inner = os.path.splitext(stem)
+        extension = inner + extension
+    return os.path.join(directory, "{}_{}{}".format(stem, space_name, extension))
+
 
 class Task(object):
     num_cores: int
     temp_dir: Text
+    events_file: Optional[Text]
+    profile: Union[bool, List[Text]]
     type: TASK_TYPE
 
     def __init__(self, global_settings):
         self.num_cores = global_settings["num_cores"]
         self.temp_dir = global_settings["temp_dir"]
+        self.events_file = global_settings["events_file"]
+        self.profile = global_settings["profile"]
 
 
 class Create(Task):
@@ -105,6 +152,11 @@ class Create(Task):
     space_settings: SpaceSettings
     headers: bool
     numbered: bool
+    streaming: bool
+    chunk_size: int
+    decomposition: DECOMPOSITION
+    oversamples: int
+    power_iters: int
 
     def __init__(self, global_settings, task_settings):
         super().__init__(global_settings)
@@ -119,6 +171,26 @@ class Create(Task):
             self.numbered = task_settings["from"]["numbered"]
         except KeyError:
             self.numbered = False
+        try:
+            self.streaming = task_settings["options"]["streaming"]
+        except KeyError:
+            self.streaming = False
+        try:
+            self.chunk_size = int(task_settings["options"]["chunk_size"])
+        except KeyError:
+            self.chunk_size = 20000
+        try:
+            self.decomposition = DECOMPOSITION[task_settings["options"]["decomposition"].upper()]
+        except KeyError:
+            self.decomposition = DECOMPOSITION.GENSIM
+        try:
+            self.oversamples = int(task_settings["options"]["oversamples"])
+        except KeyError:
+            self.oversamples = 10
+        try:
+            self.power_iters = int(task_settings["options"]["power_iters"])
+        except KeyError:
+            self.power_iters = 2
         self.space_settings = SpaceSettings(space_name=task_settings["options"]["space"],
                                             load=False,
                                             dimensions=task_settings["options"]["dimensions"],
@@ -130,30 +202,50 @@ class Create(Task):
 class Rotate(Task):
     space_name: Text
 
-    def __init__(self, global_settings, task_settings):
+    def __init__(self, global_settings, task_settings, space_name=None):
         super().__init__(global_settings)
         self.type = TASK_TYPE.ROTATE
-        self.space_name = task_settings["options"]["space"]
+        self.space_name = space_name or task_settings["options"]["space"]
 
 
-class Project(Task):
+class Compile(Task):
     space_name: Text
+
+    def __init__(self, global_settings, task_settings):
+        super().__init__(global_settings)
+        self.type = TASK_TYPE.COMPILE
+        try:
+            self.space_name = task_settings["options"]["space"]
+        except KeyError:
+            raise Exception("A semantic space must be specified.")
+
+
+class Project(Task):
+    space_names: List[Text]
+    ds_names: List[Text]
     source_files: List[Text]
-    space_settings: Optional[SpaceSettings]
+    compare_to_files: Optional[List[Text]]
+    space_settings: Optional[List[SpaceSettings]]
     headers: bool
     numbered: bool
     rotated: bool
+    scaled: bool
+    cache: bool
+    incremental: bool
+    resume: bool
     output_format: OUTPUT_FORMAT
     output_file: Optional[Text]
+    precision: PRECISION
 
     def __init__(self, global_settings, task_settings):
         super().__init__(global_settings)
         self.type = TASK_TYPE.PROJECT
         self.source_files = task_settings["from"]["files"]
         try:
-            self.space_name = task_settings["options"]["space"]
+            self.compare_to_files = task_settings["from"]["compare_to"]
         except KeyError:
-            raise Exception("A semantic space must be specified.")
+            self.compare_to_files = None
+        self.space_names = space_names_of(task_settings)
         try:
             self.headers = task_settings["from"]["headers"]
         except KeyError:
@@ -165,9 +257,26 @@ class Project(Task):
         try:
             self.rotated = task_settings["options"]["rotated"]
             if self.rotated:
-                global_settings["tasks"].append(Rotate(global_settings, task_settings))
+                for space_name in self.space_names:
+                    global_settings["tasks"].append(Rotate(global_settings, task_settings, space_name))
         except KeyError:
             self.rotated = False
+        try:
+            self.scaled = task_settings["options"]["scaled"]
+        except KeyError:
+            self.scaled = False
+        try:
+            self.incremental = task_settings["options"]["incremental"]
+        except KeyError:
+            self.incremental = False
+        try:
+            self.cache = task_settings["options"]["cache"] or self.incremental
+        except KeyError:
+            self.cache = self.incremental
+        try:
+            self.resume = task_settings["options"]["resume"]
+        except KeyError:
+            self.resume = False
         if "output" in task_settings:
             try:
                 self.output_format = OUTPUT_FORMAT[task_settings["output"]["format"].upper()]
@@ -177,34 +286,78 @@ class Project(Task):
                 self.output_file = task_settings["output"]["file_name"]
             except:
                 raise Exception("You must specify an output file_name when saving output")
+            self.ds_names = ds_names_of(task_settings, self.space_names,
+                                        "No ds_name specified, using 'sim' as name of data source in vectors")
             try:
-                self.ds_name = task_settings["output"]["ds_name"]
+                self.precision = PRECISION[task_settings["output"]["precision"].upper()]
             except KeyError:
-                self.ds_name = 'sim'
-                warnings.warn("No ds_name specified, using 'sim' as name of data source in vectors")
+                self.precision = PRECISION.FLOAT32
 
 
 class Calculate(Task):
     space_name: Text
     distance_metric: DISTANCE_METRIC
     output_file: Text
+    csv_file: Text
     ds_name: Text
+    last_space: bool
     output_format: OUTPUT_FORMAT
-
-    def __init__(self, global_settings, task_settings):
+    block_size: int
+    pair_mode: PAIR_MODE
+    pair_file: Optional[Text]
+    output_mode: OUTPUT_MODE
+    k: Optional[int]
+    threshold: Optional[float]
+    compress: bool
+    compression_level: int
+    storage: SIM_STORAGE
+    precision: PRECISION
+    incremental: bool
+    resume: bool
+    checkpoint_interval: float
+    shard: Optional[int]
+    shards: Optional[int]
+
+    def __init__(self, global_settings, task_settings, project=True):
         super().__init__(global_settings)
         self.type = TASK_TYPE.CALCULATE
-        global_settings["tasks"].append(Project(global_settings, task_settings))
+        try:
+            self.shard, self.shards = [int(n) for n in str(task_settings["options"]["shard"]).split("/")]
+        except KeyError:
+            self.shard, self.shards = None, None
+        except ValueError:
+            raise Exception("shard must be given as i/n, for example 1/4")
+        if self.shard is not None and not 1 <= self.shard <= self.shards:
+            raise Exception("shard {} of {} does not exist".format(self.shard, self.shards))
+        # every shard reads the vectors that were projected once before they started
+        if project and self.shard is None:
+            global_settings["tasks"].append(Project(global_settings, task_settings))
 
         try:
-            self.space_name = task_settings["options"]["space"]
+            self.pair_mode = PAIR_MODE[task_settings["from"]["pairs"].upper()]
         except KeyError:
-            raise Exception("A semantic space must be specified.")
+            self.pair_mode = PAIR_MODE.ALL
+        if self.pair_mode == PAIR_MODE.CROSS and "compare_to" not in task_settings["from"]:
+            raise Exception("You must specify compare_to files when pairs is cross")
+        if self.pair_mode == PAIR_MODE.LIST:
+            try:
+                self.pair_file = task_settings["from"]["pair_file"]
+            except KeyError:
+                raise Exception("You must specify a pair_file when pairs is list")
+        else:
+            self.pair_file = None
+
+        space_names = space_names_of(task_settings)
         try:
-            self.distance_metric = DISTANCE_METRIC[task_settings["options"]["space"].upper()]
+            self.distance_metric = DISTANCE_METRIC[task_settings["options"]["distance_metric"].upper()]
         except KeyError:
             warnings.warn("Illegal distance metric specified. Using cosine similarity instead.")
-        
+            self.distance_metric = DISTANCE_METRIC.COSINE
+        try:
+            self.block_size = int(task_settings["options"]["block_size"])
+        except KeyError:
+            self.block_size = 1000
+
         try:
             self.output_format = OUTPUT_FORMAT[task_settings["output"]["format"]]
         except KeyError:
@@ -213,17 +366,271 @@ class Calculate(Task):
             self.output_file = task_settings["output"]["file_name"]
         except KeyError:
             raise Exception("You must specify an output file_name when saving output")
+        ds_names = ds_names_of(task_settings, space_names,
+                               "No ds_name specified, using 'sim' as name of data source in sims")
+        try:
+            self.compress = task_settings["output"]["gzip"]
+        except KeyError:
+            self.compress = False
+        try:
+            self.output_mode = OUTPUT_MODE[task_settings["output"]["mode"].upper()]
+        except KeyError:
+            self.output_mode = OUTPUT_MODE.MATRIX
+        if self.output_mode == OUTPUT_MODE.TOP_K:
+            if self.pair_mode == PAIR_MODE.LIST:
+                raise Exception("The top_k output mode cannot be used when pairs is list")
+            try:
+                self.k = int(task_settings["output"]["k"])
+            except KeyError:
+                raise Exception("You must specify k when the output mode is top_k")
+            if self.k < 1:
+                raise Exception("k must be at least 1 when the output mode is top_k")
+        else:
+            self.k = None
+        if self.output_mode == OUTPUT_MODE.THRESHOLD:
+            if self.pair_mode == PAIR_MODE.LIST:
+                raise Exception("The threshold output mode cannot be used when pairs is list")
+            try:
+                self.threshold = float(task_settings["output"]["threshold"])
+            except KeyError:
+                raise Exception("You must specify a threshold when the output mode is threshold")
+        else:
+            self.threshold = None
+        try:
+            self.storage = SIM_STORAGE[task_settings["output"]["storage"].upper()]
+        except KeyError:
+            self.storage = SIM_STORAGE.FULL
+        if self.storage == SIM_STORAGE.CONDENSED and (self.pair_mode != PAIR_MODE.ALL or
+                                                     self.output_mode != OUTPUT_MODE.MATRIX):
+            raise Exception("Condensed storage can only be used for a matrix of all pairs")
+        try:
+            self.precision = PRECISION[task_settings["output"]["precision"].upper()]
+        except KeyError:
+            self.precision = PRECISION.FLOAT32
+        try:
+            self.compression_level = int(task_settings["output"]["compression_level"])
+        except KeyError:
+            self.compression_level = 1
+        if not 0 <= self.compression_level <= 9:
+            raise Exception("compression_level must be between 0 and 9")
+        try:
+            self.incremental = task_settings["options"]["incremental"]
+        except KeyError:
+            self.incremental = False
+        if self.incremental and (self.pair_mode != PAIR_MODE.ALL or self.output_mode != OUTPUT_MODE.MATRIX or
+                                 self.storage != SIM_STORAGE.FULL or self.output_format != OUTPUT_FORMAT.H5):
+            raise Exception("Incremental updates can only be used for a full h5 matrix of all pairs")
+        try:
+            self.resume = task_settings["options"]["resume"]
+        except KeyError:
+            self.resume = False
+        if self.resume and self.output_mode == OUTPUT_MODE.THRESHOLD and self.output_format == OUTPUT_FORMAT.CSV:
+            raise Exception("A threshold edge list streamed to CSV can not be resumed, use the H5 format instead")
+        try:
+            self.checkpoint_interval = float(task_settings["options"]["checkpoint_interval"])
+        except KeyError:
+            self.checkpoint_interval = 60.0
+        if self.shard is not None:
+            self.check_sharded()
+        if len(space_names) > 1 and (self.shard is not None or not project):
+            raise Exception("Shards can only be calculated and merged for one semantic space at a time")
+        self.for_space(space_names[-1], ds_names[-1], len(space_names) > 1, True)
+        # the vectors of every space are projected by one task, then each space is calculated in turn
+        for space_name, ds_name in zip(space_names[:-1], ds_names[:-1]):
+            task = copy.copy(self)
+            task.for_space(space_name, ds_name, True, False)
+            global_settings["tasks"].append(task)
+
+    def for_space(self, space_name, ds_name, several, last):
+        self.space_name = space_name
+        self.ds_name = ds_name
+        self.csv_file = space_file_name(self.output_file, space_name) if several else self.output_file
+        self.last_space = last
+
+    def check_sharded(self):
+        if (self.pair_mode == PAIR_MODE.LIST or self.output_mode != OUTPUT_MODE.MATRIX or
+                self.storage != SIM_STORAGE.FULL or self.incremental):
+            raise Exception("Only a full matrix of all or cross pairs can be split into shards")
+
+
+class MergeShards(Calculate):
+
+    def __init__(self, global_settings, task_settings):
+        super().__init__(global_settings, task_settings, project=False)
+        self.type = TASK_TYPE.MERGE
+        try:
+            self.shards = int(task_settings["options"]["shards"])
+        except KeyError:
+            raise Exception("You must specify the number of shards to merge")
+        self.check_sharded()
+
+
+class BuildIndex(Task):
+    file_name: Text
+    ds_name: Text
+    distance_metric: DISTANCE_METRIC
+    n_lists: Optional[int]
+    iterations: int
+    train_size: int
+    recall_sample: int
+    k: int
+    n_probe: int
+
+    def __init__(self, global_settings, task_settings):
+        super().__init__(global_settings)
+        self.type = TASK_TYPE.INDEX
+        if "from" in task_settings:
+            if len(space_names_of(task_settings)) > 1:
+                raise Exception("An index can only be built from the vectors of one semantic space")
+            global_settings["tasks"].append(Project(global_settings, task_settings))
+        try:
+            self.file_name = task_settings["output"]["file_name"]
+        except KeyError:
+            raise Exception("You must specify the file_name of the vectors to index")
+        try:
+            self.ds_name = task_settings["output"]["ds_name"]
+        except KeyError:
+            self.ds_name = 'sim'
+            warnings.warn("No ds_name specified, indexing the 'sim' vectors")
+        try:
+            self.distance_metric = DISTANCE_METRIC[task_settings["options"]["distance_metric"].upper()]
+        except KeyError:
+            self.distance_metric = DISTANCE_METRIC.COSINE
+        try:
+            self.n_lists = int(task_settings["options"]["n_lists"])
+        except KeyError:
+            self.n_lists = None
+        try:
+            self.iterations = int(task_settings["options"]["iterations"])
+        except KeyError:
+            self.iterations = 20
+        try:
+            self.train_size = int(task_settings["options"]["train_size"])
+        except KeyError:
+            self.train_size = 100000
+        try:
+            self.recall_sample = int(task_settings["options"]["recall_sample"])
+        except KeyError:
+            self.recall_sample = 1000
+        try:
+            self.k = int(task_settings["options"]["k"])
+        except KeyError:
+            self.k = 10
+        try:
+            self.n_probe = int(task_settings["options"]["n_probe"])
+        except KeyError:
+            self.n_probe = 8
+
+
+class QueryIndex(Task):
+    index_file: Text
+    index_ds: Text
+    ids: Optional[List[int]]
+    k: int
+    n_probe: Optional[int]
+    block_size: int
+    output_format: OUTPUT_FORMAT
+    output_file: Text
+    ds_name: Text
+    compress: bool
+
+    def __init__(self, global_settings, task_settings):
+        super().__init__(global_settings)
+        self.type = TASK_TYPE.QUERY
+        try:
+            self.index_file = task_settings["options"]["index"]
+        except KeyError:
+            raise Exception("You must specify the index file to query")
+        try:
+            self.index_ds = task_settings["options"]["index_ds"]
+        except KeyError:
+            self.index_ds = 'sim'
+        try:
+            self.ids = [int(i) for i in task_settings["from"]["ids"]]
+        except KeyError:
+            self.ids = None
+            if "files" not in task_settings.get("from", {}):
+                raise Exception("You must specify either the ids or the files of the texts to query")
+            if len(space_names_of(task_settings)) > 1:
+                raise Exception("Queries can only be projected into one semantic space")
+            global_settings["tasks"].append(Project(global_settings, task_settings))
+        try:
+            self.k = int(task_settings["options"]["k"])
+        except KeyError:
+            self.k = 10
+        try:
+            self.n_probe = int(task_settings["options"]["n_probe"])
+        except KeyError:
+            self.n_probe = None
+        try:
+            self.block_size = int(task_settings["options"]["block_size"])
+        except KeyError:
+            self.block_size = 1000
+        try:
+            self.output_format = OUTPUT_FORMAT[task_settings["output"]["format"].upper()]
+        except KeyError:
+            self.output_format = OUTPUT_FORMAT.H5
+        try:
+            self.output_file = task_settings["output"]["file_name"]
+        except KeyError:
+            raise Exception("You must specify an output file_name when saving output")
         try:
             self.ds_name = task_settings["output"]["ds_name"]
         except KeyError:
             self.ds_name = 'sim'
-            warnings.warn("No ds_name specified, using 'sim' as name of data source in sims")
+        try:
+            self.compress = task_settings["output"]["gzip"]
+        except KeyError:
+            self.compress = False
+        if self.ids is not None and self.output_format == OUTPUT_FORMAT.H5 and self.output_file == self.index_file:
+            raise Exception("Neighbours of indexed texts must be saved to a different file than the index")
+
+
+class Serve(Task):
+    space_names: List[Text]
+    host: Text
+    port: int
+    socket: Optional[Text]
+    batch_window: float
+    max_batch: int
+
+    def __init__(self, global_settings, task_settings):
+        super().__init__(global_settings)
+        self.type = TASK_TYPE.SERVE
+        try:
+            self.space_names = task_settings["options"]["spaces"]
+        except KeyError:
+            raise Exception("At least one semantic space must be specified.")
+        if isinstance(self.space_names, str):
+            self.space_names = [self.space_names]
+        try:
+            self.host = task_settings["options"]["host"]
+        except KeyError:
+            self.host = "127.0.0.1"
+        try:
+            self.port = int(task_settings["options"]["port"])
+        except KeyError:
+            self.port = 8080
+        try:
+            self.socket = "/app/data/{}".format(task_settings["options"]["socket"])
+        except KeyError:
+            self.socket = None
+        try:
+            self.batch_window = float(task_settings["options"]["batch_window"]) / 1000
+        except KeyError:
+            self.batch_window = 0.005
+        try:
+            self.max_batch = int(task_settings["options"]["max_batch"])
+        except KeyError:
+            self.max_batch = 10000
 
 
 class Config(object):
     tasks: List[Task]
     temp_dir: str
     num_cores: int
+    events_file: Optional[str]
+    profile: Union[bool, List[str]]
 
     def __init__(self):
         self._read_config(CONFIG_FILE)
@@ -234,6 +641,8 @@ class Config(object):
         global_settings = {
             "temp_dir": self.temp_dir,
             "num_cores": self.num_cores,
+            "events_file": self.events_file,
+            "profile": self.profile,
             "tasks": self.tasks
         }
 
@@ -247,24 +656,41 @@ class Config(object):
     def _load_global(self):
         try:
             self.num_cores = int(self._cfg["options"]["cores"])
-            return
         except KeyError:
             warnings.warn("Number of cores not specified, defaulting to one less than max")
+            self.num_cores = mp.cpu_count() - 1
         except TypeError:
             warnings.warn("The number of cores must be an int, defaulting to one less than max insetad")
-        finally:
             self.num_cores = mp.cpu_count() - 1
+        try:
+            self.events_file = "/app/data/{}".format(self._cfg["options"]["events"])
+        except KeyError:
+            self.events_file = None
+        try:
+            self.profile = self._cfg["options"]["profile"]
+        except KeyError:
+            self.profile = False
 
     def _load_task(self, global_settings, task_settings):
         try:
             if task_settings["type"] == "create_space":
                 return Create(global_settings, task_settings)
+            elif task_settings["type"] == "compile_space":
+                return Compile(global_settings, task_settings)
             elif task_settings["type"] == "rotate_space":
                 return Rotate(global_settings, task_settings)
             elif task_settings["type"] == "project_sentences":
                 return Project(global_settings, task_settings)
             elif task_settings["type"] == "calculate_similarity":
                 return Calculate(global_settings, task_settings)
+            elif task_settings["type"] == "build_index":
+                return BuildIndex(global_settings, task_settings)
+            elif task_settings["type"] == "query_index":
+                return QueryIndex(global_settings, task_settings)
+            elif task_settings["type"] == "merge_shards":
+                return MergeShards(global_settings, task_settings)
+            elif task_settings["type"] == "serve":
+                return Serve(global_settings, task_settings)
             else:
                 raise Exception("Invalid task type supplied")
         except KeyError:
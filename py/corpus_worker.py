@@ -0,0 +1,53 @@
+from collections import Counter
+
+from py.document_cleaner import DocumentCleaner
+
+
+class CorpusBuilder(object):
+
+    def __init__(self, space_settings, token2id=None):
+        self.cleaner = DocumentCleaner(space_settings)
+        self.token2id = token2id
+
+    def count_terms(self, documents):
+        # counts are kept in the order Dictionary.add_documents would assign ids: by first
+        # appearance, and alphabetically among the words a document introduces
+        documents = self.cleaner.clean_documents(documents)
+        counts = {}
+        num_pos = 0
+        for document in documents:
+            counter = Counter(document)
+            for token in sorted(counter):
+                try:
+                    counts[token][0] += counter[token]
+                    counts[token][1] += 1
+                except KeyError:
+                    counts[token] = [counter[token], 1]
+            num_pos += len(document)
+        return documents, counts, num_pos
+
+    def bag_of_words(self, documents):
+        token2id = self.token2id
+        return [sorted(Counter(token2id[w] for w in d if w in token2id).items()) for d in documents]
+
+cb: CorpusBuilder
+
+
+def init_worker(space_settings, token2id=None):
+    global cb
+    cb = CorpusBuilder(space_settings, token2id)
+
+
+def count_terms(documents):
+    global cb
+    return cb.count_terms(documents)
+
+
+def bag_of_words(documents):
+    global cb
+    return cb.bag_of_words(documents)
+
+
+def bag_of_words_from_lines(lines):
+    global cb
+    return cb.bag_of_words([line.split() for line in lines])
@@ -0,0 +1,23 @@
+import gzip
+import io
+
+import numpy as np
+
+WRITE_BUFFER = 16 * 1024 * 1024
+ROW_FORMAT = "%d,%d,%.3f\n"
+
+
+def open_csv(file_name, compress=False):
+    if compress:
+        return io.TextIOWrapper(io.BufferedWriter(gzip.open(file_name, "wb", compresslevel=6), WRITE_BUFFER))
+    return open(file_name, "w", buffering=WRITE_BUFFER)
+
+
+def format_rows(left_ids, right_ids, sims):
+    # a single % over the whole block is far cheaper than formatting every value separately
+    sims = np.asarray(sims)
+    values = [None] * (3 * sims.size)
+    values[0::3] = np.broadcast_to(left_ids, sims.shape).ravel().tolist()
+    values[1::3] = np.broadcast_to(right_ids, sims.shape).ravel().tolist()
+    values[2::3] = sims.ravel().tolist()
+    return (ROW_FORMAT * sims.size) % tuple(values)
@@ -1,9 +1,5 @@
 import os
 from shutil import rmtree
-from py.space_creator import Creator
-from py.projector import Projector
-from py.sim_calculator import SimCalculator
-from py.rotator import Rotator
 from py.configurator import Config
 from py.utils import *
 from functools import partial
@@ -19,14 +15,34 @@ announcer("Created temp directory at {}".format(cfg.temp_dir))
 
 try:
     for task in cfg.tasks:
+        # task modules are imported as needed so that short jobs do not pay for loading gensim
         if task.type == TASK_TYPE.CREATE:
+            from py.space_creator import Creator
             t = Creator(task, start_time)
+        elif task.type == TASK_TYPE.COMPILE:
+            from py.space_compiler import Compiler
+            t = Compiler(task, start_time)
         elif task.type == TASK_TYPE.ROTATE:
+            from py.rotator import Rotator
             t = Rotator(task, start_time)
         elif task.type == TASK_TYPE.PROJECT:
+            from py.projector import Projector
             t = Projector(task, start_time)
         elif task.type == TASK_TYPE.CALCULATE:
+            from py.sim_calculator import SimCalculator
             t = SimCalculator(task, start_time)
+        elif task.type == TASK_TYPE.INDEX:
+            from py.indexer import Indexer
+            t = Indexer(task, start_time)
+        elif task.type == TASK_TYPE.QUERY:
+            from py.searcher import Searcher
+            t = Searcher(task, start_time)
+        elif task.type == TASK_TYPE.MERGE:
+            from py.shard_merger import ShardMerger
+            t = ShardMerger(task, start_time)
+        elif task.type == TASK_TYPE.SERVE:
+            from py.server import Server
+            t = Server(task, start_time)
         else:
             raise Exception("Illegal task_type")
         t.main()
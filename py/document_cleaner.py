@@ -1,7 +1,10 @@
 import re
+from functools import lru_cache
 from nltk import PorterStemmer
 from py.configurator import SpaceSettings
 
+STEM_CACHE_SIZE = 2 ** 18
+
 
 class DocumentCleaner(object):
     def __init__(self, config: SpaceSettings):
@@ -10,14 +13,18 @@ class DocumentCleaner(object):
 
         if config.remove_numbers:
             self.patt = re.compile('[^a-zA-Z]')
+            self.batch_patt = re.compile('[^a-zA-Z\n]')
         else:
             self.patt = re.compile('[^a-zA-Z0-9]')
+            self.batch_patt = re.compile('[^a-zA-Z0-9\n]')
         if config.stopwords:
-            self.stopwords = config.stopwords
+            self.stopwords = frozenset(config.stopwords)
         else:
             self.stopwords = None
         if config.stem:
             self.stem = PorterStemmer()
+            # most occurrences are of a few thousand words, so each is only stemmed once per worker
+            self.stem_word = lru_cache(maxsize=STEM_CACHE_SIZE)(self._try_stem)
         else:
             self.stem = None
 
@@ -27,24 +34,37 @@ class DocumentCleaner(object):
         except IndexError:
             return ""
 
+    def clean_words(self, words):
+        if self.stopwords:
+            words = [w for w in words if w not in self.stopwords]
+        if self.stem:
+            words = [self.stem_word(w) for w in words]
+            if self.stopwords:
+                words = [w for w in words if w not in self.stopwords]
+        return [w for w in words if len(w) > 0]
+
     def clean_document(self, document):
         try:
             if not self.case_sensitive:
                 document = document.lower()
             if self.remove_punctuation:
                 document = self.patt.sub(' ', document)
-            words = document.split()
-            if self.stopwords:
-                words = [w for w in words if w not in self.stopwords]
-            if self.stem:
-                words = [self._try_stem(w) for w in words]
-                if self.stopwords:
-                    words = [w for w in words if w not in self.stopwords]
-            words = [w for w in words if len(w) > 0]
-            return words
+            return self.clean_words(document.split())
         except AttributeError:
             return []
 
+    def clean_documents(self, documents):
+        if not all(isinstance(d, str) for d in documents):
+            return [self.clean_document(d) for d in documents]
+        # lower casing and the punctuation pattern run once over the whole batch instead of once per document;
+        # newlines only ever separate words, so they can be swapped for spaces and used to split the batch
+        text = "\n".join(d.replace("\n", " ") for d in documents)
+        if not self.case_sensitive:
+            text = text.lower()
+        if self.remove_punctuation:
+            text = self.batch_patt.sub(' ', text)
+        return [self.clean_words(d.split()) for d in text.split("\n")] if documents else []
+
 dc: DocumentCleaner
 
 
@@ -58,6 +78,11 @@ def clean_document(document):
     return dc.clean_document(document)
 
 
+def clean_documents(documents):
+    global dc
+    return dc.clean_documents(documents)
+
+
 def clean_keyed_document(key, document):
     global dc
     return key, dc.clean_document(document)
\ No newline at end of file
@@ -0,0 +1,78 @@
+import cProfile
+import json
+import resource
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# progress events are written at most this often, plus once when the last block finishes
+PROGRESS_INTERVAL = 1.0
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def workers_peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+class Stage(object):
+
+    def __init__(self, name, items=None):
+        self.name = name
+        self.items = items
+        self.fields = {}
+        self.start = time.time()
+
+
+class EventLog(object):
+    # one JSON object per line for every finished stage, so runs can be analysed without scraping stdout
+
+    def __init__(self, process, config, profile_prefix):
+        self.process = process
+        self.task = config.type.name.lower()
+        self.file_name = config.events_file
+        self.profile = config.profile
+        self.profile_prefix = profile_prefix
+        self.last_progress = 0
+
+    def emit(self, event, **fields):
+        if not self.file_name:
+            return
+        record = {"time": datetime.now().isoformat(), "event": event, "process": self.process, "task": self.task}
+        record.update(fields)
+        with open(self.file_name, "a") as out_file:
+            out_file.write(json.dumps(record) + "\n")
+
+    def profiled(self, name):
+        return self.profile is True or (isinstance(self.profile, list) and name in self.profile)
+
+    @contextmanager
+    def stage(self, name, items=None):
+        stage = Stage(name, items)
+        profiler = cProfile.Profile() if self.profiled(name) else None
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield stage
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats("{}.{}.{}.prof".format(self.profile_prefix, self.process.lower(), name))
+        seconds = time.time() - stage.start
+        self.emit("stage",
+                  stage=name,
+                  seconds=seconds,
+                  items=stage.items,
+                  items_per_second=stage.items / seconds if stage.items is not None and seconds > 0 else None,
+                  peak_rss_mb=peak_rss_mb(),
+                  workers_peak_rss_mb=workers_peak_rss_mb(),
+                  **stage.fields)
+
+    def progress(self, stage, done, total, **fields):
+        now = time.time()
+        if done < total and now - self.last_progress < PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        self.emit("progress", stage=stage, done=done, total=total, peak_rss_mb=peak_rss_mb(), **fields)
@@ -0,0 +1,71 @@
+import time
+from functools import partial
+
+import h5py
+import numpy as np
+
+from py.ann_index import build_index, default_n_lists, index_dir, recall_at_k
+from py.configurator import BuildIndex
+from py.events import EventLog
+from py.sim_metrics import save_prepared_vectors
+from py.utils import *
+
+
+class Indexer(object):
+
+    def __init__(self, config: BuildIndex, start_time):
+        self._cfg = config
+        self.announcer = partial(announcer, process="Indexer", start=start_time)
+        self.events = EventLog("Indexer", config, "/app/data/output/{}".format(config.file_name))
+        self.directory = index_dir(config.file_name, config.ds_name)
+        self.prepared_file = "{}/{}_index.npy".format(config.temp_dir, config.ds_name)
+
+    def prepare_vectors(self):
+        with h5py.File("/app/data/output/{}".format(self._cfg.file_name), 'r') as f:
+            vectors = f["/vectors/{}".format(self._cfg.ds_name)]
+            save_prepared_vectors(vectors, self._cfg.distance_metric, self.prepared_file, 10000)
+            return f["/input/id"][:]
+
+    def n_probes(self, n_lists):
+        # the configured n_probe plus every power of two below the number of lists
+        return sorted({min(self._cfg.n_probe, n_lists)} | {2 ** i for i in range(n_lists.bit_length())
+                                                          if 2 ** i < n_lists})
+
+    def evaluate_recall(self, index):
+        vectors = np.load(self.prepared_file, mmap_mode='r')
+        rng = np.random.RandomState(1)
+        sample = np.sort(rng.choice(len(index), min(self._cfg.recall_sample, len(index)), replace=False))
+        queries = np.array(vectors[sample])
+        k = max(1, min(self._cfg.k, len(index) - 1))
+        _, exact = index.exact_search(queries, k, sample)
+        recall = {}
+        for n_probe in self.n_probes(index.n_lists):
+            start = time.time()
+            _, found = index.search(queries, k, n_probe, sample)
+            seconds = time.time() - start
+            recall[n_probe] = {"recall": recall_at_k(found, exact),
+                               "queries_per_second": len(sample) / seconds if seconds > 0 else None}
+            self.announcer("n_probe {:>5d}: recall@{} {:.3f}".format(n_probe, k, recall[n_probe]["recall"]))
+            self.events.emit("recall", n_probe=n_probe, k=k, sample=len(sample), **recall[n_probe])
+        index.settings["recall"] = {"k": k, "sample": len(sample), "n_probe": recall}
+        index.save_settings(self.directory)
+
+    def main(self):
+        self.announcer("Started")
+        with self.events.stage("prepare_vectors") as stage:
+            ids = self.prepare_vectors()
+            stage.items = len(ids)
+        self.announcer("Prepared {} vectors".format(len(ids)))
+        n_lists = self._cfg.n_lists or default_n_lists(len(ids))
+        with self.events.stage("build", len(ids)) as stage:
+            index = build_index(self.prepared_file, ids, self.directory, n_lists, self._cfg.iterations,
+                                self._cfg.train_size, {"distance_metric": self._cfg.distance_metric.name.lower(),
+                                                       "n_probe": self._cfg.n_probe,
+                                                       "file_name": self._cfg.file_name,
+                                                       "ds_name": self._cfg.ds_name})
+            stage.fields["iterations"] = index.settings["iterations"]
+        self.announcer("Built {} lists in {} iterations".format(index.n_lists, index.settings["iterations"]))
+        if self._cfg.recall_sample > 0 and len(index) > 1:
+            with self.events.stage("recall", min(self._cfg.recall_sample, len(index))):
+                self.evaluate_recall(index)
+        self.announcer("Saved index to {}".format(self.directory))
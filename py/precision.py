@@ -0,0 +1,46 @@
+import numpy as np
+
+from py.utils import PRECISION
+
+DTYPES = {PRECISION.FLOAT32: np.float32,
+          PRECISION.FLOAT16: np.float16,
+          PRECISION.INT16: np.int16,
+          PRECISION.INT8: np.int8}
+
+
+def sim_dtype(precision):
+    return np.dtype(DTYPES[precision])
+
+
+def vector_dtype(precision):
+    # projections are only ever reduced to half precision, integers would lose too much of the small dimensions
+    return np.dtype(np.float32 if precision == PRECISION.FLOAT32 else np.float16)
+
+
+def sim_scale(precision):
+    # both distance metrics score in [-1, 1], which is spread over the whole range of an integer type
+    if np.issubdtype(sim_dtype(precision), np.integer):
+        return 1.0 / np.iinfo(sim_dtype(precision)).max, 0.0
+    return None
+
+
+def quantize(sims, precision):
+    dtype = sim_dtype(precision)
+    if not np.issubdtype(dtype, np.integer):
+        return np.asarray(sims).astype(dtype, copy=False)
+    scale, offset = sim_scale(precision)
+    limit = np.iinfo(dtype).max
+    return np.clip(np.rint((np.asarray(sims) - offset) / scale), -limit, limit).astype(dtype)
+
+
+def save_scale(ds, precision):
+    ds.attrs["precision"] = precision.name.lower()
+    if sim_scale(precision) is not None:
+        ds.attrs["scale"], ds.attrs["offset"] = sim_scale(precision)
+
+
+def dequantize(values, ds):
+    values = np.asarray(values, dtype=np.float32)
+    if "scale" in ds.attrs:
+        values = values * np.float32(ds.attrs["scale"]) + np.float32(ds.attrs["offset"])
+    return values
@@ -1,32 +1,48 @@
 import multiprocessing as mp
 import os
 import shutil
+from contextlib import ExitStack
 
 import h5py
 import numpy as np
 
 import py.vec_worker as vw
-import py.document_cleaner as dc
 from functools import partial
-from gensim.corpora import Dictionary
-from gensim.models import LsiModel
+from py.batch_projector import BatchProjector, compiled_space_dir, load_batch_projector
 from py.configurator import Project, SpaceSettings
+from py.events import EventLog
+from py.precision import vector_dtype
 from py.utils import *
+from py.vector_cache import VectorCache, text_hashes
+
+BATCH_SIZE = 1000
+
+
+def write_rows(group, name, kept, rows, **kwargs):
+    # keeps the first kept rows of a resizable dataset and replaces everything after them
+    if name in group and (group[name].maxshape[0] is not None or group[name].dtype != kwargs["dtype"]):
+        del group[name]
+    if name not in group:
+        group.create_dataset(name, shape=(0,) + rows.shape[1:], maxshape=(None,) + rows.shape[1:], **kwargs)
+    ds = group[name]
+    ds.resize(kept + len(rows), axis=0)
+    if len(rows):
+        ds[kept:] = rows
+    return ds
 
 
 class Projector(object):
     def __init__(self, config: Project, start_time):
         self._cfg = config
-        self.dictionary = Dictionary.load("/app/data/spaces/%s/dictionary" % self._cfg.space_name)
-        self.model = LsiModel.load("/app/data/spaces/%s/lsi" % self._cfg.space_name)
+        self.model_name = "lsi_rotated" if self._cfg.rotated else "lsi"
+        self.space_dirs = [self.space_dir(space_name) for space_name in self._cfg.space_names]
         self.raw_sentences = dict()
-        self.sentences = dict()
-        self.vectors = dict()
         self.announcer = partial(announcer, process="Projector", start=start_time)
+        self.events = EventLog("Projector", config, "/app/data/output/{}".format(getattr(config, "output_file", "")))
 
-    def load_sentences(self):
+    def load_sentences(self, source_files):
         self.raw_sentences = {}
-        for source_file in self._cfg.source_files:
+        for source_file in source_files:
             with open("/app/data/{}".format(source_file)) as in_file:
                 new_documents = {}
                 if self._cfg.headers:
@@ -43,31 +59,34 @@ class Projector(object):
                         sentence_id += 1
                 self.raw_sentences.update(new_documents)
 
+    def space_dir(self, space_name):
+        if os.path.isdir(compiled_space_dir(space_name, self.model_name)):
+            return compiled_space_dir(space_name, self.model_name)
+        return "{}/spaces/{}/{}".format(self._cfg.temp_dir, space_name, self.model_name)
+
     def load_space_settings(self):
-        self._cfg.space_settings = SpaceSettings(space_name=self._cfg.space_name, load=True)
-
-    def vectorize_sentences(self):
-        with mp.Pool(self._cfg.num_cores, initializer=dc.init_worker, initargs=(self._cfg.space_settings,)) as pool:
-            self.sentences = {k: v for k, v in pool.starmap_async(func=dc.clean_keyed_document,
-                                                                  iterable=self.raw_sentences.items()).get()}
-        with mp.Pool(self._cfg.num_cores, initializer=vw.init_worker, initargs=(self.dictionary, self.model)) as pool:
-            self.vectors = {k: v for k, v in pool.starmap_async(func=vw.vectorize,
-                                                                iterable=self.sentences.items()).get()}
-        good_vectors = {k: v for k, v in self.vectors.items() if v.shape == (self._cfg.space_settings.dimensions, )}
-        bad_vectors = {k: np.zeros(shape=(self._cfg.space_settings.dimensions, ), dtype=np.float32) for k, v in self.vectors.items() if v.shape != (self._cfg.space_settings.dimensions, )}
-        self.vectors = good_vectors
-        self.vectors.update(bad_vectors)
-        # self.announcer("space_name: {}\n"
-        #                "                                        output_file: {}\n"
-        #                "                                        ds_name: {}\n"
-        #                "                                        raw_sentences: {}\n"
-        #                "                                        vectors: {}".format(self._cfg.space_name,
-        #                                                                             self._cfg.output_file,
-        #                                                                             self._cfg.ds_name,
-        #                                                                             len(self.raw_sentences),
-        #                                                                             len(self.vectors)))
-
-    def save_hdf5(self):
+        self._cfg.space_settings = [SpaceSettings(space_name=space_name, load=True)
+                                    for space_name in self._cfg.space_names]
+
+    def share_space(self):
+        # workers memory map the projection instead of each receiving a pickled copy of the model
+        for space_name, space_dir in zip(self._cfg.space_names, self.space_dirs):
+            if not os.path.isdir(space_dir):
+                load_batch_projector(space_name, self.model_name).save(space_dir)
+
+    def cleaning_groups(self, spaces):
+        # spaces that clean texts the same way share one pool, so each text is only cleaned once for all of them
+        groups = {}
+        for space in spaces:
+            groups.setdefault(self._cfg.space_settings[space].cleaning_key(), []).append(space)
+        return list(groups.values())
+
+    def pool(self, spaces):
+        return mp.Pool(self._cfg.num_cores, initializer=vw.init_worker,
+                       initargs=(self._cfg.space_settings[spaces[0]], [self.space_dirs[i] for i in spaces],
+                                 self._cfg.scaled))
+
+    def open_output(self):
         try:
             os.mkdir("/app/data/output")
             shutil.chown("/app/data/output/", user=1000)
@@ -76,49 +95,171 @@ class Projector(object):
         if self._cfg.output_format == OUTPUT_FORMAT.H5:
             f = h5py.File('/app/data/output/{}'.format(self._cfg.output_file), 'a')
         else:
-            f = h5py.File('{}/{}.h5'.format(self._cfg.temp_dir, self._cfg.output_file), 'a')
+            if not self._cfg.resume and os.path.isfile(intermediate_file(self._cfg.output_file)):
+                os.remove(intermediate_file(self._cfg.output_file))
+            f = h5py.File(intermediate_file(self._cfg.output_file), 'a')
         shutil.chown(f.filename, user=1000)
-        sorted_vectors = [(k, v) for (k, v) in sorted(self.vectors.items(), key=lambda x: x[0])]
-        # unused_keys = [k for k in self.raw_sentences if k not in [x[0] for x in sorted_vectors]]
-        vec_array = np.stack([x[1] for x in sorted_vectors])
+        return f
+
+    def save_input(self, root, ids, hashes):
         string_dt = h5py.h5t.special_dtype(vlen=str)
-        vectors = f.require_group("vectors")
-        vector = vectors.require_dataset(self._cfg.ds_name,
-                                         dtype=np.float32,
-                                         shape=vec_array.shape,
-                                         data=vec_array,
-                                         compression="gzip",
-                                         compression_opts=9,
-                                         shuffle=True,
-                                         fillvalue=0.0
-                                         )
-        in_data = f.require_group("input")
+        in_data = root.require_group("input")
+        if self._cfg.incremental:
+            kept = self.kept_rows(in_data, ids, hashes)
+            write_rows(in_data, "id", kept, np.array(ids[kept:], dtype='u8'), dtype='u8', chunks=True)
+            write_rows(in_data, "hash", kept, hashes[kept:], dtype='u8', chunks=True)
+            write_rows(in_data, "text", kept, np.array([self.raw_sentences[k] for k in ids[kept:]], dtype=object),
+                       dtype=string_dt, chunks=True, compression="gzip", compression_opts=9, shuffle=True)
+            return kept
+        if "hash" in in_data and not np.array_equal(in_data["hash"][:], hashes):
+            # the texts changed since this file was written, so none of the old rows can be kept
+            for name in ("id", "hash", "text"):
+                if name in in_data:
+                    del in_data[name]
         in_data.require_dataset("id",
                                 dtype='u8',
-                                shape=(len(sorted_vectors),),
-                                data=np.array([x[0] for x in sorted_vectors]))
+                                shape=(len(ids),),
+                                data=np.array(ids, dtype='u8'))
+        in_data.require_dataset("hash",
+                                dtype='u8',
+                                shape=(len(ids),),
+                                data=hashes)
         in_data.require_dataset("text",
                                 dtype=string_dt,
-                                shape=(len(sorted_vectors),),
-                                data=[self.raw_sentences[x[0]].encode('utf-8') for x in sorted_vectors],
+                                shape=(len(ids),),
+                                data=[self.raw_sentences[k].encode('utf-8') for k in ids],
                                 compression="gzip",
                                 compression_opts=9,
                                 shuffle=True)
-        # if len(unused_keys) > 0:
-        #     skipped = f.require_group("skip")
-        #     skipped.require_dataset("id",
-        #                             dtype=int,
-        #                             shape=(len(unused_keys),),
-        #                             data=unused_keys)
-        f.flush()
-        f.close()
+        return 0
+
+    @staticmethod
+    def kept_rows(in_data, ids, hashes):
+        # number of leading rows that are the same as the last time this file was written
+        if any(name not in in_data or in_data[name].maxshape[0] is not None for name in ("id", "hash", "text")):
+            return 0
+        old_ids, old_hashes = in_data["id"][:], in_data["hash"][:]
+        n = min(len(old_ids), len(ids))
+        same = (old_ids[:n] == np.array(ids[:n], dtype='u8')) & (old_hashes[:n] == hashes[:n])
+        return n if same.all() else int(np.argmin(same))
+
+    def project_cached(self, pool, caches, ids, hashes):
+        # texts missing from any of the caches are folded into every space of the group at once
+        looked_up = [cache.lookup(hashes) for cache in caches]
+        missing = np.flatnonzero(~np.logical_and.reduce([found for found, _ in looked_up]))
+        batches = ((offset, [self.raw_sentences[ids[i]] for i in missing[offset:offset + BATCH_SIZE]])
+                   for offset in range(0, len(missing), BATCH_SIZE))
+        for offset, blocks in pool.imap_unordered(vw.vectorize, batches):
+            for (_, vectors), block in zip(looked_up, blocks):
+                vectors[missing[offset:offset + len(block)]] = block
+        for cache, (found, vectors) in zip(caches, looked_up):
+            cache.add(hashes[~found], vectors[~found])
+        self.announcer("Projected {} sentences, {} found in cache".format(len(missing), len(hashes) - len(missing)))
+        return [vectors for _, vectors in looked_up]
+
+    def unchanged_rows(self, vectors, ds_name, cache, kept):
+        old = vectors.get(ds_name)
+        if (old is None or old.maxshape[0] is not None or old.attrs.get("space") != cache.fingerprint or
+                old.dtype != vector_dtype(self._cfg.precision)):
+            return 0
+        # rows the similarity matrix can keep, including changes from projections it has not seen yet
+        return min(kept, old.attrs.get("unchanged", kept))
+
+    def vectorize_sentences(self, pool, root, ids, hashes, spaces, kept=0):
+        projectors = [BatchProjector.load(self.space_dirs[i], self._cfg.scaled) for i in spaces]
+        ds_names = [self._cfg.ds_names[i] for i in spaces]
+        vectors = root.require_group("vectors")
+        if self._cfg.cache:
+            caches = [VectorCache(self._cfg.space_settings[i], projector, self._cfg.scaled)
+                      for i, projector in zip(spaces, projectors)]
+        if self._cfg.incremental:
+            starts = [self.unchanged_rows(vectors, ds_name, cache, kept) for ds_name, cache in zip(ds_names, caches)]
+            start = min(starts)
+            projected = self.project_cached(pool, caches, ids[start:], hashes[start:])
+            for ds_name, cache, projector, unchanged, rows in zip(ds_names, caches, projectors, starts, projected):
+                vector = write_rows(vectors, ds_name, unchanged, rows[unchanged - start:],
+                                    dtype=vector_dtype(self._cfg.precision),
+                                    chunks=(BATCH_SIZE, projector.dimensions),
+                                    compression="gzip",
+                                    compression_opts=9,
+                                    shuffle=True,
+                                    fillvalue=0.0)
+                vector.attrs["space"] = cache.fingerprint
+                vector.attrs["unchanged"] = unchanged
+            return
+        for ds_name in ds_names:
+            if ds_name in vectors and vectors[ds_name].dtype != vector_dtype(self._cfg.precision):
+                del vectors[ds_name]
+        datasets = [vectors.require_dataset(ds_name,
+                                            dtype=vector_dtype(self._cfg.precision),
+                                            shape=(len(ids), projector.dimensions),
+                                            chunks=(min(BATCH_SIZE, len(ids)), projector.dimensions) if ids else None,
+                                            compression="gzip",
+                                            compression_opts=9,
+                                            shuffle=True,
+                                            fillvalue=0.0)
+                    for ds_name, projector in zip(ds_names, projectors)]
+        if self._cfg.cache:
+            for vector, rows in zip(datasets, self.project_cached(pool, caches, ids, hashes)):
+                vector[:] = rows
+            return
+        batches = ((offset, [self.raw_sentences[k] for k in ids[offset:offset + BATCH_SIZE]])
+                   for offset in range(0, len(ids), BATCH_SIZE))
+        for offset, blocks in pool.imap_unordered(vw.vectorize, batches):
+            for vector, block in zip(datasets, blocks):
+                vector[offset:offset + len(block)] = block
+
+    def project(self, pools, f, source_files, group=None):
+        root = f if group is None else f.require_group(group)
+        suffix = "" if group is None else "_" + group
+        with self.events.stage("load_sentences" + suffix) as stage:
+            self.load_sentences(source_files)
+            ids = sorted(self.raw_sentences)
+            hashes = text_hashes([self.raw_sentences[k] for k in ids])
+            stage.items = len(ids)
+        self.announcer("Loaded Sentences")
+        if self._cfg.resume:
+            pools = [(spaces, pool) for spaces, pool in pools
+                     if not all(self.projected(root, self._cfg.ds_names[i], hashes) for i in spaces)]
+            if not pools:
+                self.announcer("Reusing projected vectors")
+                return
+        with self.events.stage("save_input" + suffix, len(ids)):
+            kept = self.save_input(root, ids, hashes)
+        for spaces, pool in pools:
+            with self.events.stage("vectorize" + suffix, len(ids)) as stage:
+                stage.fields["spaces"] = [self._cfg.space_names[i] for i in spaces]
+                self.vectorize_sentences(pool, root, ids, hashes, spaces, kept)
+            self.announcer("Vectorized Sentences in {}".format(", ".join(stage.fields["spaces"])))
+            f.flush()
+            for i in spaces:
+                root["vectors/{}".format(self._cfg.ds_names[i])].attrs["projected"] = len(ids)
+            f.flush()
+
+    def projected(self, root, ds_name, hashes):
+        # vectors are only marked as projected once every row has been written
+        try:
+            vectors = root["vectors/{}".format(ds_name)]
+            old_hashes = root["input/hash"][:]
+        except KeyError:
+            return False
+        return (vectors.attrs.get("projected") == len(hashes) and np.array_equal(old_hashes, hashes) and
+                vectors.dtype == vector_dtype(self._cfg.precision))
 
     def main(self):
         self.load_space_settings()
         self.announcer("Loaded Space Settings")
-        self.load_sentences()
-        self.announcer("Loaded Sentences")
-        self.vectorize_sentences()
-        self.announcer("Vectorized Sentences")
-        self.save_hdf5()
+        with self.events.stage("share_space"):
+            self.share_space()
+        self.announcer("Shared Space with workers")
+        f = self.open_output()
+        with ExitStack() as stack:
+            # texts are cleaned once per distinct cleaning configuration rather than once per space
+            pools = [(spaces, stack.enter_context(self.pool(spaces)))
+                     for spaces in self.cleaning_groups(range(len(self._cfg.space_names)))]
+            self.project(pools, f, self._cfg.source_files)
+            if self._cfg.compare_to_files:
+                self.project(pools, f, self._cfg.compare_to_files, "right")
+                self.announcer("Projected compare_to Sentences")
+        f.close()
         self.announcer("Saved into HDF5 format")
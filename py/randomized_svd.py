@@ -0,0 +1,20 @@
+import numpy as np
+from scipy.linalg import qr, svd
+
+
+def orthonormal_basis(matrix):
+    return qr(matrix, mode='economic', overwrite_a=True, check_finite=False)[0]
+
+
+def randomized_svd(matrix, rank, oversamples=10, power_iters=2, seed=0):
+    # Halko, Martinsson and Tropp's randomized range finder with subspace iteration;
+    # every dense step is a BLAS call on a terms by (rank + oversamples) matrix
+    samples = min(rank + oversamples, min(matrix.shape))
+    matrix_t = matrix.T.tocsr()
+    omega = np.random.RandomState(seed).standard_normal((matrix.shape[1], samples)).astype(matrix.dtype)
+    q = orthonormal_basis(matrix.dot(omega))
+    for _ in range(power_iters):
+        # re-orthonormalise between multiplications so the small singular values are not lost to rounding
+        q = orthonormal_basis(matrix.dot(orthonormal_basis(matrix_t.dot(q))))
+    u, s, _ = svd(np.asarray(matrix_t.dot(q)).T, full_matrices=False, overwrite_a=True, check_finite=False)
+    return np.dot(q, u[:, :rank]), s[:rank]
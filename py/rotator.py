@@ -1,25 +1,45 @@
 import os
+import time
 from functools import partial
 import numpy as np
 from numpy.linalg import svd
 from gensim.models import LsiModel
+from py.batch_projector import compile_space, compiled_space_dir
 from py.configurator import Rotate
+from py.events import EventLog
 from py.utils import *
 
+# vocabulary rows handled per matrix product
+BLOCK_SIZE = 2 ** 16
 
-def varimax(phi, gamma=1, q=20, tol=1e-6):
+
+def varimax(phi, gamma=1, q=100, tol=1e-6, block_size=BLOCK_SIZE):
+    # only the cubic term needs the rotated loadings row by row; phi.T phi is k by k, so the
+    # rest of the gradient is computed from it without going back over the vocabulary
     p, k = phi.shape
+    phi = np.asarray(phi, dtype=np.float32)
+    gram = np.zeros((k, k))
+    for b in range(0, p, block_size):
+        gram += np.dot(phi[b:b + block_size].T, phi[b:b + block_size])
     r = np.eye(k)
     d = 0
     for i in range(q):
         d_old = d
-        Lambda = np.dot(phi, r)
-        u, s, vh = svd(np.dot(phi.T, np.asarray(Lambda) ** 3 - (gamma / p) * np.dot(Lambda, np.diag(np.diag(np.dot(Lambda.T, Lambda))))))
+        r32 = r.astype(np.float32)
+        cubes = np.zeros((k, k))
+        for b in range(0, p, block_size):
+            cubes += np.dot(phi[b:b + block_size].T, np.dot(phi[b:b + block_size], r32) ** 3)
+        gram_r = np.dot(gram, r)
+        u, s, vh = svd(cubes - (gamma / p) * gram_r * np.einsum('ij,ij->j', r, gram_r))
         r = np.dot(u, vh)
         d = np.sum(s)
-        if d/d_old < tol:
+        if d_old and d / d_old < 1 + tol:
             break
-    return np.dot(phi, r)
+    r32 = r.astype(np.float32)
+    rotated = np.empty_like(phi)
+    for b in range(0, p, block_size):
+        rotated[b:b + block_size] = np.dot(phi[b:b + block_size], r32)
+    return rotated, i + 1
 
 
 class Rotator(object):
@@ -27,21 +47,30 @@ class Rotator(object):
     def __init__(self, config: Rotate, start_time):
         self._cfg = config
         self.announcer = partial(announcer, process="Rotator", start=start_time)
+        self.events = EventLog("Rotator", config, "/app/data/spaces/{}/profile".format(config.space_name))
 
     def check_if_rotation_exists(self):
         return os.path.isfile("/app/data/spaces/{}/lsi_rotated".format(self._cfg.space_name))
 
     def rotate(self):
         self.announcer("starting to rotate")
-        model = LsiModel.load("/app/data/spaces/{}/lsi".format(self._cfg.space_name))
+        with self.events.stage("load_model"):
+            model = LsiModel.load("/app/data/spaces/{}/lsi".format(self._cfg.space_name))
         self.announcer("loaded model")
-        model.projection.u = varimax(model.projection.u)
-        self.announcer("rotated u matrix")
-        model.save("/app/data/spaces/{}/lsi_rotated".format(self._cfg.space_name))
+        with self.events.stage("rotate", model.projection.u.shape[0]) as stage:
+            model.projection.u, iterations = varimax(model.projection.u)
+            stage.fields["iterations"] = iterations
+        self.announcer("rotated u matrix in {} iterations, {:.1f}s".format(iterations, time.time() - stage.start))
+        with self.events.stage("save"):
+            model.save("/app/data/spaces/{}/lsi_rotated".format(self._cfg.space_name))
         self.announcer("saved rotated matrix")
 
     def main(self):
         if not self.check_if_rotation_exists():
             self.rotate()
         else:
-            self.announcer("Rotation already exists, will not be recreated")
\ No newline at end of file
+            self.announcer("Rotation already exists, will not be recreated")
+        if not os.path.isdir(compiled_space_dir(self._cfg.space_name, "lsi_rotated")):
+            with self.events.stage("compile"):
+                compile_space(self._cfg.space_name, "lsi_rotated")
+            self.announcer("compiled rotated space")
\ No newline at end of file
@@ -0,0 +1,112 @@
+import multiprocessing as mp
+import os
+from functools import partial
+
+import h5py
+import numpy as np
+
+import py.ann_worker as aw
+from py.ann_index import IVFIndex, index_dir
+from py.configurator import QueryIndex
+from py.csv_writer import format_rows, open_csv
+from py.events import EventLog
+from py.sim_metrics import prepare_vectors
+from py.utils import *
+
+
+class Searcher(object):
+
+    def __init__(self, config: QueryIndex, start_time):
+        self._cfg = config
+        self.announcer = partial(announcer, process="Searcher", start=start_time)
+        self.events = EventLog("Searcher", config, "/app/data/output/{}".format(config.output_file))
+        self.directory = index_dir(config.index_file, config.index_ds)
+        if not os.path.isdir(self.directory):
+            raise Exception("No index has been built for {} in {}".format(config.index_ds, config.index_file))
+        self.index = IVFIndex.load(self.directory)
+        try:
+            self.n_probe = self._cfg.n_probe or self.index.settings["n_probe"]
+        except KeyError:
+            self.n_probe = 8
+
+    def open_output(self):
+        if self._cfg.output_format == OUTPUT_FORMAT.H5:
+            return h5py.File('/app/data/output/{}'.format(self._cfg.output_file), 'a')
+        return h5py.File(intermediate_file(self._cfg.output_file), 'a')
+
+    def load_queries(self, f):
+        # texts that are already indexed are searched with their stored vectors and never find themselves
+        if self._cfg.ids is not None:
+            ids = np.array(self._cfg.ids, dtype=self.index.ids.dtype)
+            order = np.argsort(self.index.ids, kind='stable')
+            positions = order[np.minimum(np.searchsorted(self.index.ids, ids, sorter=order), len(order) - 1)]
+            found = self.index.ids[positions] == ids
+            if not np.all(found):
+                raise KeyError("Unknown text ids: {}".format(ids[~found]))
+            return ids, self.index.vectors_of(positions), positions
+        ids = f["/input/id"][:]
+        vectors = prepare_vectors(f["/vectors/{}".format(self._cfg.ds_name)][:], self.index.distance_metric)
+        return ids, vectors, None
+
+    def tasks(self, vectors, exclude):
+        for offset in range(0, len(vectors), self._cfg.block_size):
+            yield (offset,
+                   vectors[offset:offset + self._cfg.block_size],
+                   self._cfg.k,
+                   self.n_probe,
+                   None if exclude is None else exclude[offset:offset + self._cfg.block_size])
+
+    def create_neighbor_datasets(self, f, ids):
+        neighbors = f.require_group("neighbors")
+        if self._cfg.ds_name in neighbors:
+            del neighbors[self._cfg.ds_name]
+        group = neighbors.create_group(self._cfg.ds_name)
+        group.attrs["k"] = self._cfg.k
+        group.attrs["n_probe"] = self.n_probe
+        group.attrs["index"] = "{}/{}".format(self._cfg.index_file, self._cfg.index_ds)
+        group.attrs["distance_metric"] = self.index.distance_metric.name.lower()
+        # the query ids live with the neighbours, /input/id of the file belongs to its projected vectors
+        group.create_dataset("id", dtype='u8', data=ids)
+        count = len(ids)
+        chunks = (max(1, min(self._cfg.block_size, count)), max(self._cfg.k, 1))
+        index_ds = group.create_dataset("index", dtype=np.int64, shape=(count, self._cfg.k), chunks=chunks,
+                                        compression="gzip", compression_opts=9, shuffle=True)
+        score_ds = group.create_dataset("score", dtype=np.float32, shape=(count, self._cfg.k), chunks=chunks,
+                                        fillvalue=np.nan, compression="gzip", compression_opts=9, shuffle=True)
+        return index_ds, score_ds
+
+    def search(self, f, ids, vectors, exclude):
+        num_tasks = -(-len(vectors) // self._cfg.block_size)
+        if self._cfg.output_format == OUTPUT_FORMAT.H5:
+            index_ds, score_ds = self.create_neighbor_datasets(f, ids)
+        else:
+            out_file = open_csv('/app/data/output/{}'.format(self._cfg.output_file), self._cfg.compress)
+        try:
+            with mp.Pool(self._cfg.num_cores, initializer=aw.init_worker, initargs=(self.directory,)) as pool:
+                for i, (offset, found, sims) in enumerate(pool.imap(aw.search, self.tasks(vectors, exclude))):
+                    if self._cfg.output_format == OUTPUT_FORMAT.H5:
+                        index_ds[offset:offset + len(found)] = found
+                        score_ds[offset:offset + len(found)] = sims
+                    else:
+                        rows, cols = np.nonzero(found >= 0)
+                        out_file.write(format_rows(ids[offset + rows], self.index.ids[found[rows, cols]],
+                                                   sims[rows, cols]))
+                    self.events.progress("search", i + 1, num_tasks, queries=offset + len(found))
+        finally:
+            if self._cfg.output_format != OUTPUT_FORMAT.H5:
+                out_file.close()
+
+    def main(self):
+        self.announcer("Started")
+        f = self.open_output()
+        with self.events.stage("load_queries") as stage:
+            ids, vectors, exclude = self.load_queries(f)
+            stage.items = len(ids)
+        self.announcer("Loaded {} queries".format(len(ids)))
+        with self.events.stage("search", len(ids)):
+            self.search(f, ids, vectors, exclude)
+        f.close()
+        if self._cfg.output_format == OUTPUT_FORMAT.CSV:
+            os.remove(intermediate_file(self._cfg.output_file))
+        self.announcer("Found {} neighbours of each query with {} of {} lists probed".format(
+            self._cfg.k, min(self.n_probe, self.index.n_lists), self.index.n_lists))
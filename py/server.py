@@ -0,0 +1,259 @@
+import json
+import os
+import queue
+import signal
+import socketserver
+import threading
+import time
+from functools import partial
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+
+from py.batch_projector import compiled_space_dir, load_batch_projector, load_compiled_space
+from py.configurator import Serve, SpaceSettings
+from py.document_cleaner import DocumentCleaner
+from py.sim_metrics import prepare_vectors
+from py.utils import *
+
+
+def text_list(request, name, default=None):
+    texts = request[name] if default is None else request.get(name, default)
+    if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+        raise ValueError("{} must be a list of strings".format(name))
+    return texts
+
+
+class ProjectionRequest(object):
+
+    def __init__(self, texts, compare_to=None, distance_metric=None, pairs=None):
+        self.texts = texts
+        # requests with a distance metric are scored as well as projected
+        self.compare_to = compare_to or []
+        self.distance_metric = distance_metric
+        self.pairs = pairs
+        self.vectors = None
+        self.sims = None
+        self.error = None
+        self.done = threading.Event()
+
+    def __len__(self):
+        return len(self.texts) + len(self.compare_to)
+
+    def sides(self):
+        vectors = prepare_vectors(self.vectors, self.distance_metric)
+        left = vectors[:len(self.texts)]
+        return left, vectors[len(self.texts):] if self.compare_to else left
+
+
+class ProjectionBatcher(threading.Thread):
+    # requests that arrive within batch_window of each other are cleaned, projected and scored together
+
+    def __init__(self, space_name, batch_window, max_batch):
+        super().__init__(daemon=True)
+        self.cleaner = DocumentCleaner(SpaceSettings(space_name=space_name, load=True))
+        if os.path.isdir(compiled_space_dir(space_name)):
+            self.projector = load_compiled_space(space_name)
+        else:
+            self.projector = load_batch_projector(space_name)
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.requests = queue.Queue()
+
+    def submit(self, request):
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request
+
+    def project(self, texts):
+        return self.submit(ProjectionRequest(texts)).vectors
+
+    def score(self, texts, compare_to, distance_metric, pairs=None):
+        return self.submit(ProjectionRequest(texts, compare_to, distance_metric, pairs)).sims
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        size = len(batch[0])
+        deadline = time.time() + self.batch_window
+        while size < self.max_batch:
+            try:
+                request = self.requests.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request)
+        return batch
+
+    @staticmethod
+    def score_batch(requests):
+        # the stacked texts of every request are scored against the stacked texts they are compared to in one
+        # matmul, and each request takes its own block; max_batch bounds the size of the product
+        matrices = [r for r in requests if r.pairs is None]
+        if matrices:
+            sides = [r.sides() for r in matrices]
+            sims = np.dot(np.vstack([left for left, _ in sides]), np.vstack([right for _, right in sides]).T)
+            row, col = 0, 0
+            for request, (left, right) in zip(matrices, sides):
+                request.sims = sims[row:row + len(left), col:col + len(right)].copy()
+                row, col = row + len(left), col + len(right)
+        pairs = [r for r in requests if r.pairs is not None]
+        if pairs:
+            sides = [r.sides() for r in pairs]
+            sims = np.einsum('ij,ij->i',
+                             np.vstack([left[r.pairs[:, 0]] for r, (left, _) in zip(pairs, sides)]),
+                             np.vstack([right[r.pairs[:, 1]] for r, (_, right) in zip(pairs, sides)]))
+            offset = 0
+            for request in pairs:
+                request.sims = sims[offset:offset + len(request.pairs)]
+                offset += len(request.pairs)
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                vectors = self.projector.project(self.cleaner.clean_documents(
+                    [t for r in batch for t in r.texts + r.compare_to]))
+                offset = 0
+                for request in batch:
+                    request.vectors = vectors[offset:offset + len(request)]
+                    offset += len(request)
+                self.score_batch([r for r in batch if r.distance_metric is not None])
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+
+class SimilarityService(object):
+
+    def __init__(self, batchers):
+        self.batchers = batchers
+
+    def batcher(self, request):
+        try:
+            return self.batchers[request["space"]]
+        except KeyError:
+            raise ValueError("Unknown space: {}".format(request.get("space")))
+
+    def project(self, request):
+        return {"vectors": self.batcher(request).project(text_list(request, "texts")).tolist()}
+
+    def similarity(self, request):
+        batcher = self.batcher(request)
+        texts = text_list(request, "texts")
+        compare_to = text_list(request, "compare_to", [])
+        distance_metric = DISTANCE_METRIC[request.get("distance_metric", "cosine").upper()]
+        # bad requests are turned away here, before they can fail the batch they would have joined
+        if "pairs" in request:
+            pairs = np.array(request["pairs"], dtype=np.int64)
+            if not pairs.size:
+                pairs = pairs.reshape(0, 2)
+            if pairs.ndim != 2 or pairs.shape[1] != 2:
+                raise ValueError("pairs must be a list of [text, compare_to text] positions")
+            if (pairs < 0).any() or (pairs[:, 0] >= len(texts)).any() or \
+                    (pairs[:, 1] >= len(compare_to or texts)).any():
+                raise ValueError("pairs must only hold positions of the texts that were sent")
+            return {"scores": batcher.score(texts, compare_to, distance_metric, pairs).tolist()}
+        if "k" in request and int(request["k"]) < 1:
+            raise ValueError("k must be at least 1")
+        sims = batcher.score(texts, compare_to, distance_metric)
+        if "k" not in request:
+            return {"scores": sims.tolist()}
+        if not compare_to:
+            np.fill_diagonal(sims, -np.inf)
+        k = min(int(request["k"]), sims.shape[1] - (0 if compare_to else 1))
+        index = np.argsort(-sims, axis=1, kind='stable')[:, :k]
+        return {"index": index.tolist(), "scores": np.take_along_axis(sims, index, axis=1).tolist()}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    routes = {"/project": "project", "/similarity": "similarity"}
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.respond(200, {"spaces": sorted(self.server.service.batchers)})
+        else:
+            self.respond(404, {"error": "Unknown path: {}".format(self.path)})
+
+    def do_POST(self):
+        if self.path not in self.routes:
+            return self.respond(404, {"error": "Unknown path: {}".format(self.path)})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
+            response = getattr(self.server.service, self.routes[self.path])(request)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            return self.respond(400, {"error": str(e)})
+        except Exception as e:
+            # anything else is our fault, but the client still gets an answer instead of a dropped connection
+            return self.respond(500, {"error": "{}: {}".format(type(e).__name__, e)})
+        self.respond(200, response)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ("local", 0)
+
+
+class Server(object):
+
+    def __init__(self, config: Serve, start_time):
+        self._cfg = config
+        self.announcer = partial(announcer, process="Server", start=start_time)
+
+    def load_spaces(self):
+        batchers = {}
+        for space_name in self._cfg.space_names:
+            batchers[space_name] = ProjectionBatcher(space_name, self._cfg.batch_window, self._cfg.max_batch)
+            batchers[space_name].start()
+            self.announcer("Loaded space {}".format(space_name))
+        return batchers
+
+    @staticmethod
+    def stop(*args):
+        raise KeyboardInterrupt
+
+    def main(self):
+        # docker stop sends SIGTERM; shut down the same way as an interrupt so everything is cleaned up
+        signal.signal(signal.SIGTERM, self.stop)
+        service = SimilarityService(self.load_spaces())
+        if self._cfg.socket:
+            if os.path.exists(self._cfg.socket):
+                os.remove(self._cfg.socket)
+            httpd = ThreadingUnixHTTPServer(self._cfg.socket, RequestHandler)
+            self.announcer("Listening on {}".format(self._cfg.socket))
+        else:
+            httpd = ThreadingHTTPServer((self._cfg.host, self._cfg.port), RequestHandler)
+            self.announcer("Listening on {}:{}".format(self._cfg.host, self._cfg.port))
+        httpd.service = service
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            self.announcer("Stopping")
+        finally:
+            httpd.server_close()
+            if self._cfg.socket and os.path.exists(self._cfg.socket):
+                os.remove(self._cfg.socket)
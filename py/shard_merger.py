@@ -0,0 +1,83 @@
+import os
+import warnings
+from functools import partial
+
+import h5py
+import numpy as np
+
+from py.configurator import MergeShards
+from py.events import EventLog
+from py.sim_calculator import SimCalculator
+from py.utils import *
+
+
+class ShardMerger(SimCalculator):
+    # assembles the blocks written by calculate_similarity tasks run with shard: i/n into one sim dataset
+
+    def __init__(self, config: MergeShards, start_time):
+        super().__init__(config, start_time)
+        self.announcer = partial(announcer, process="Merger", start=start_time)
+        self.events = EventLog("Merger", config, "/app/data/output/{}".format(config.output_file))
+
+    def create_sim_dataset(self):
+        for name in ("/sim/{}".format(self._cfg.ds_name), "/checkpoints/{}".format(self._cfg.ds_name)):
+            if name in self.f:
+                warnings.warn("Replacing {} with the merged shards".format(name))
+                del self.f[name]
+        super().create_sim_dataset()
+
+    def open_shards(self):
+        # every shard is checked before anything is copied so an incomplete job fails straight away
+        rows, cols, block_size = self.checkpoint_layout()
+        assigned = self.block_shards()
+        shards = []
+        for shard in range(1, self._cfg.shards + 1):
+            file_name = shard_file(self.file_name, shard, self._cfg.shards)
+            if not os.path.isfile(file_name):
+                raise Exception("Shard {} of {} has not been calculated".format(shard, self._cfg.shards))
+            f = h5py.File(file_name, 'r')
+            shards.append(f)
+            try:
+                checkpoint = f["/checkpoints/{}".format(self._cfg.ds_name)]
+                ds = f["/sim/{}".format(self._cfg.ds_name)]
+            except KeyError:
+                raise Exception("Shard {} of {} has no scores for {}".format(shard, self._cfg.shards,
+                                                                            self._cfg.ds_name))
+            if ds.dtype != self.ds.dtype:
+                raise Exception("Shard {} of {} was stored with a different precision".format(shard, self._cfg.shards))
+            if (checkpoint.shape != (rows, cols) or checkpoint.attrs["block_size"] != block_size or
+                    checkpoint.attrs["texts"] != len(self.vectors) or
+                    checkpoint.attrs["right_texts"] != len(self.right_vectors) or
+                    checkpoint.attrs.get("inputs") != self.input_digest()):
+                raise Exception("Shard {} of {} was calculated from different texts or with a different "
+                                "block_size".format(shard, self._cfg.shards))
+            missing = np.count_nonzero((assigned == shard) & ~checkpoint[:])
+            if missing:
+                raise Exception("Shard {} of {} is missing {} of its {} blocks".format(
+                    shard, self._cfg.shards, missing, np.count_nonzero(assigned == shard)))
+        return assigned, shards
+
+    def merge(self):
+        assigned, shards = self.open_shards()
+        chunks = self.chunks(self.vectors)
+        right_chunks = self.chunks(self.right_vectors)
+        for shard, f in enumerate(shards, 1):
+            ds = f["/sim/{}".format(self._cfg.ds_name)]
+            for left_index, right_index in zip(*np.nonzero(assigned == shard)):
+                (lm, lx), (rm, rx) = chunks[left_index], right_chunks[right_index]
+                self.ds[lm:lx, rm:rx] = ds[lm:lx, rm:rx]
+                self.commit(left_index, right_index)
+            f.close()
+            self.announcer("Merged shard {:>4d}/{:>4d}".format(shard, len(shards)))
+        if not self.done.all():
+            raise Exception("{} blocks are missing from the merged shards".format(np.count_nonzero(~self.done)))
+        return int(np.count_nonzero(assigned > 0))
+
+    def main(self):
+        self.announcer("Started merging {} shards".format(self._cfg.shards))
+        with self.events.stage("merge") as stage:
+            stage.items = self.merge()
+        self.finish()
+        for shard in range(1, self._cfg.shards + 1):
+            os.remove(shard_file(self.file_name, shard, self._cfg.shards))
+        self.announcer("Removed the shard files")
@@ -1,62 +1,560 @@
+import multiprocessing as mp
+import os
+import time
+import warnings
 from functools import partial
-from itertools import combinations
+from hashlib import blake2b
 
 import h5py
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
 
+import py.sim_worker as sw
 from py.configurator import Calculate
+from py.events import EventLog
+from py.csv_writer import format_rows, open_csv
+from py.precision import dequantize, save_scale, sim_dtype
+from py.sim_metrics import condensed_offset, save_prepared_vectors
 from py.utils import *
 
-CHUNK_SIZE = 100
+# upper bound on the values in one strip of a condensed matrix
+STRIP_VALUES = 2 ** 24
+CONDENSED_CHUNK = 2 ** 18
+EDGE_CHUNK = 2 ** 16
 
 
 class SimCalculator(object):
     def __init__(self, config: Calculate, start_time):
         self.announcer = partial(announcer, process="Calculator", start=start_time)
+        self.events = EventLog("Calculator", config, "/app/data/output/{}".format(config.output_file))
         self._cfg = config
         if config.output_format == OUTPUT_FORMAT.H5:
-            self.f = h5py.File('/app/data/output/{}'.format(self._cfg.output_file), 'r+')
+            self.file_name = '/app/data/output/{}'.format(self._cfg.output_file)
         else:
-            self.f = h5py.File('{}/{}.h5'.format(self._cfg.temp_dir, self._cfg.output_file), 'r+')
+            self.file_name = intermediate_file(self._cfg.output_file)
+        if self._cfg.shard is None:
+            self.f = h5py.File(self.file_name, 'r+')
+            self.out = self.f
+        else:
+            # shards share the projected vectors and each write their blocks to a file of their own
+            self.f = h5py.File(self.file_name, 'r')
+            self.out = self.open_shard()
         self.vectors = self.f['/vectors/{}'.format(self._cfg.ds_name)]
-        self.sim = self.f.require_group("sim")
+        self.vectors_file = '{}/{}.npy'.format(self._cfg.temp_dir, self._cfg.ds_name)
+        if self._cfg.pair_mode == PAIR_MODE.CROSS:
+            self.right_vectors = self.f['/right/vectors/{}'.format(self._cfg.ds_name)]
+            self.right_vectors_file = '{}/{}_right.npy'.format(self._cfg.temp_dir, self._cfg.ds_name)
+        else:
+            self.right_vectors = self.vectors
+            self.right_vectors_file = self.vectors_file
+        if not len(self.vectors) or not len(self.right_vectors):
+            raise Exception("There are no texts to compare in {}, check the input files".format(self._cfg.ds_name))
+        self.block_size = min(self._cfg.block_size, len(self.vectors), len(self.right_vectors))
+        self.computed = 0
+        self.reused = False
+        self.edges = 0
+        if self._cfg.output_mode == OUTPUT_MODE.TOP_K:
+            self.create_neighbor_datasets()
+        elif self._cfg.output_mode == OUTPUT_MODE.THRESHOLD:
+            self.create_edge_datasets()
+        else:
+            self.create_sim_dataset()
+        self.open_checkpoint()
+
+    def open_shard(self):
+        file_name = shard_file(self.file_name, self._cfg.shard, self._cfg.shards)
+        if not self._cfg.resume and os.path.isfile(file_name):
+            os.remove(file_name)
+        out = h5py.File(file_name, 'a')
+        out.attrs["shard"] = self._cfg.shard
+        out.attrs["shards"] = self._cfg.shards
+        return out
+
+    def block_shards(self):
+        # upper triangle blocks are dealt out in turn so that every shard gets the same number of them
+        rows, cols, _ = self.checkpoint_layout()
+        if self._cfg.pair_mode == PAIR_MODE.ALL:
+            blocks = np.triu(np.ones((rows, cols), dtype=bool))
+        else:
+            blocks = np.ones((rows, cols), dtype=bool)
+        shards = np.full((rows, cols), -1, dtype=np.int64)
+        shards[blocks] = np.arange(np.count_nonzero(blocks)) % self._cfg.shards + 1
+        return shards
+
+    def checkpoint_layout(self):
+        # one flag per unit of work the workers are given, stored as a grid of left by right blocks
+        if self._cfg.output_mode == OUTPUT_MODE.TOP_K:
+            return len(self.chunks(self.vectors)), 1, self.block_size
+        elif self._cfg.pair_mode == PAIR_MODE.LIST:
+            return -(-len(self.pairs) // self.pair_batch_size), 1, self.pair_batch_size
+        elif self._cfg.storage == SIM_STORAGE.CONDENSED:
+            return len(self.chunks(self.vectors, self.strip_size)), 1, self.strip_size
+        return len(self.chunks(self.vectors)), len(self.chunks(self.right_vectors)), self.block_size
+
+    def can_resume(self):
+        try:
+            checkpoint = self.out["/checkpoints/{}".format(self._cfg.ds_name)]
+        except KeyError:
+            return False
+        rows, cols, block_size = self.checkpoint_layout()
+        return (checkpoint.shape == (rows, cols) and checkpoint.attrs["block_size"] == block_size and
+                checkpoint.attrs["texts"] == len(self.vectors) and
+                checkpoint.attrs["right_texts"] == len(self.right_vectors) and
+                checkpoint.attrs.get("inputs") == self.input_digest())
+
+    def input_digest(self):
+        # changed texts of the same count must not be resumed with the scores of the old ones
+        digest = blake2b(digest_size=16)
+        digest.update(self.f["/input/hash"][:].tobytes())
+        if self._cfg.pair_mode == PAIR_MODE.CROSS:
+            digest.update(self.f["/right/input/hash"][:].tobytes())
+        return digest.hexdigest()
+
+    def discard(self, *names):
+        warnings.warn("{} can not be resumed, calculating it again".format(self._cfg.ds_name))
+        for name in names:
+            if name in self.out:
+                del self.out[name]
+
+    def open_checkpoint(self):
+        checkpoints = self.out.require_group("checkpoints")
+        rows, cols, block_size = self.checkpoint_layout()
+        if self._cfg.ds_name in checkpoints:
+            # blocks are only skipped when the scores they point to were kept as well
+            if self._cfg.resume and self.reused and self.can_resume():
+                self.checkpoint = checkpoints[self._cfg.ds_name]
+                self.done = self.checkpoint[:]
+                self.skip_lower_blocks()
+                self.announcer("Resuming with {} of {} blocks done".format(np.count_nonzero(self.done),
+                                                                          self.done.size))
+                self.last_checkpoint = time.time()
+                return
+            del checkpoints[self._cfg.ds_name]
+        self.checkpoint = checkpoints.create_dataset(self._cfg.ds_name, shape=(rows, cols), dtype=bool)
+        self.checkpoint.attrs["block_size"] = block_size
+        self.checkpoint.attrs["texts"] = len(self.vectors)
+        self.checkpoint.attrs["right_texts"] = len(self.right_vectors)
+        self.checkpoint.attrs["inputs"] = self.input_digest()
+        self.done = np.zeros((rows, cols), dtype=bool)
+        self.skip_lower_blocks()
+        self.checkpoint[...] = self.done
+        self.last_checkpoint = time.time()
+
+    def skip_lower_blocks(self):
+        # blocks below the diagonal are never calculated, even if the checkpoint was never saved before a crash
+        if self._cfg.pair_mode == PAIR_MODE.ALL and self.done.shape[1] > 1:
+            self.done[np.tril_indices(len(self.done), -1)] = True
+
+    def commit(self, row, col=0):
+        self.done[row, col] = True
+        if time.time() - self.last_checkpoint >= self._cfg.checkpoint_interval:
+            self.save_checkpoint()
+
+    def save_checkpoint(self):
+        # the scores reach the file before the record that says they are there
+        self.out.flush()
+        self.checkpoint[...] = self.done
+        if self._cfg.output_mode == OUTPUT_MODE.THRESHOLD:
+            # edges past this count come from blocks that are calculated again when resuming
+            self.checkpoint.attrs["edges"] = self.edges
+        self.out.flush()
+        self.last_checkpoint = time.time()
+
+    def create_sim_dataset(self):
+        self.sim = self.out.require_group("sim")
+        if self._cfg.pair_mode == PAIR_MODE.LIST:
+            self.pair_batch_size = self.block_size * 10
+        elif self._cfg.storage == SIM_STORAGE.CONDENSED:
+            self.strip_size = max(1, min(self.block_size, STRIP_VALUES // len(self.vectors)))
+        if self._cfg.incremental and self._cfg.ds_name in self.sim and self.grow_sim_dataset():
+            return
+        if self._cfg.resume and self._cfg.ds_name in self.sim:
+            if self.resume_sim_dataset():
+                return
+            self.discard("/sim/{}".format(self._cfg.ds_name), "/pairs/{}".format(self._cfg.ds_name))
+        if self._cfg.pair_mode == PAIR_MODE.LIST:
+            self.pairs = self.load_pairs()
+            self.f.require_group("pairs").create_dataset(self._cfg.ds_name,
+                                                         dtype='u8',
+                                                         data=self.pairs,
+                                                         compression="gzip",
+                                                         compression_opts=9,
+                                                         shuffle=True)
+            shape = (len(self.pairs),)
+            chunks = (min(self.pair_batch_size, max(len(self.pairs), 1)),)
+        elif self._cfg.storage == SIM_STORAGE.CONDENSED:
+            shape = (condensed_offset(len(self.vectors), len(self.vectors)),)
+            chunks = (max(1, min(CONDENSED_CHUNK, shape[0])),)
+        else:
+            shape = (len(self.vectors), len(self.right_vectors))
+            chunks = (self.block_size, self.block_size)
+        if self._cfg.incremental:
+            # later runs grow the matrix, so the chunks can not depend on how many texts there are now
+            maxshape = (None, None)
+            chunks = (self._cfg.block_size, self._cfg.block_size)
+        else:
+            maxshape = None
         self.ds = self.sim.create_dataset(self._cfg.ds_name,
-                                          dtype=np.float32,
-                                          shape=(len(self.vectors), len(self.vectors)),
-                                          fillvalue=0.0,
+                                          dtype=sim_dtype(self._cfg.precision),
+                                          shape=shape,
+                                          maxshape=maxshape,
+                                          chunks=chunks,
+                                          fillvalue=0,
                                           compression="gzip",
-                                          compression_opts=9,
+                                          compression_opts=self._cfg.compression_level,
                                           shuffle=True)
+        save_scale(self.ds, self._cfg.precision)
+        self.ds.attrs["distance_metric"] = self._cfg.distance_metric.name.lower()
+        self.ds.attrs["pairs"] = self._cfg.pair_mode.name.lower()
+        self.ds.attrs["storage"] = self._cfg.storage.name.lower()
+
+    def resume_sim_dataset(self):
+        if self._cfg.pair_mode == PAIR_MODE.LIST:
+            try:
+                self.pairs = self.f["/pairs/{}".format(self._cfg.ds_name)][:]
+            except KeyError:
+                return False
+        if not self.can_resume() or self.sim[self._cfg.ds_name].dtype != sim_dtype(self._cfg.precision):
+            return False
+        self.ds = self.sim[self._cfg.ds_name]
+        self.reused = True
+        return True
+
+    def grow_sim_dataset(self):
+        ds = self.sim[self._cfg.ds_name]
+        if (ds.maxshape != (None, None) or ds.attrs["distance_metric"] != self._cfg.distance_metric.name.lower() or
+                ds.dtype != sim_dtype(self._cfg.precision)):
+            warnings.warn("Existing sims in {} can not be updated, recalculating all of them".format(
+                self._cfg.ds_name))
+            del self.sim[self._cfg.ds_name]
+            return False
+        # only rows and columns of texts that were added or changed since the last run are calculated
+        self.computed = min(ds.shape[0], self.vectors.attrs.get("unchanged", 0))
+        ds.resize((len(self.vectors), len(self.vectors)))
+        self.ds = ds
+        self.reused = True
+        self.announcer("Keeping sims for {} of {} texts".format(self.computed, len(self.vectors)))
+        return True
+
+    def create_neighbor_datasets(self):
+        if self._cfg.pair_mode == PAIR_MODE.CROSS:
+            self.k = min(self._cfg.k, len(self.right_vectors))
+        else:
+            self.k = min(self._cfg.k, len(self.vectors) - 1)
+        if self.k < 1:
+            raise Exception("A single text has no neighbours, top_k needs at least two texts")
+        name = "/neighbors/{}".format(self._cfg.ds_name)
+        if self._cfg.resume and name in self.f:
+            if (self.can_resume() and self.f[name].attrs["k"] == self.k and
+                    self.f[name]["score"].dtype == sim_dtype(self._cfg.precision)):
+                self.index_ds = self.f[name]["index"]
+                self.score_ds = self.f[name]["score"]
+                self.reused = True
+                return
+            self.discard(name)
+        neighbors = self.f.require_group("neighbors").create_group(self._cfg.ds_name)
+        neighbors.attrs["k"] = self.k
+        neighbors.attrs["distance_metric"] = self._cfg.distance_metric.name.lower()
+        self.index_ds = neighbors.create_dataset("index",
+                                                 dtype=np.int64,
+                                                 shape=(len(self.vectors), self.k),
+                                                 chunks=(self.block_size, max(self.k, 1)),
+                                                 compression="gzip",
+                                                 compression_opts=9,
+                                                 shuffle=True)
+        self.score_ds = neighbors.create_dataset("score",
+                                                 dtype=sim_dtype(self._cfg.precision),
+                                                 shape=(len(self.vectors), self.k),
+                                                 chunks=(self.block_size, max(self.k, 1)),
+                                                 fillvalue=0,
+                                                 compression="gzip",
+                                                 compression_opts=9,
+                                                 shuffle=True)
+        save_scale(self.score_ds, self._cfg.precision)
 
-    def calculate_sims(self, left_min, left_max, right_min, right_max):
-        sims = cosine_similarity(self.vectors[left_min:left_max, :], self.vectors[right_min:right_max])
-        sims = np.nan_to_num(sims)
-        if left_min == right_min:
-            sims = np.triu(sims)
-        self.ds[left_min:left_max, right_min:right_max] = sims
+    def create_edge_datasets(self):
+        # pairs that pass the threshold are appended as they are found, the matrix itself is never allocated
+        if self._cfg.output_format == OUTPUT_FORMAT.CSV:
+            # they are streamed to the CSV file instead, which is always written from the start
+            return
+        name = "/edges/{}".format(self._cfg.ds_name)
+        if self._cfg.resume and name in self.f:
+            edges = self.f[name]
+            if (self.can_resume() and edges.attrs["threshold"] == self._cfg.threshold and
+                    edges["score"].dtype == sim_dtype(self._cfg.precision)):
+                self.row_ds, self.col_ds, self.score_ds = edges["row"], edges["col"], edges["score"]
+                self.edges = int(self.f["/checkpoints/{}".format(self._cfg.ds_name)].attrs.get("edges", 0))
+                for ds in (self.row_ds, self.col_ds, self.score_ds):
+                    ds.resize((self.edges,))
+                self.reused = True
+                return
+            self.discard(name)
+        edges = self.f.require_group("edges").create_group(self._cfg.ds_name)
+        edges.attrs["threshold"] = self._cfg.threshold
+        edges.attrs["distance_metric"] = self._cfg.distance_metric.name.lower()
+        edges.attrs["pairs"] = self._cfg.pair_mode.name.lower()
+        self.row_ds, self.col_ds, self.score_ds = [edges.create_dataset(column,
+                                                                        dtype=dtype,
+                                                                        shape=(0,),
+                                                                        maxshape=(None,),
+                                                                        chunks=(EDGE_CHUNK,),
+                                                                        compression="gzip",
+                                                                        compression_opts=9,
+                                                                        shuffle=True)
+                                                   for column, dtype in (("row", np.int64),
+                                                                         ("col", np.int64),
+                                                                         ("score", sim_dtype(self._cfg.precision)))]
+        save_scale(self.score_ds, self._cfg.precision)
+
+    def load_pairs(self):
+        pairs = []
+        with open("/app/data/{}".format(self._cfg.pair_file)) as in_file:
+            for line_number, line in enumerate(in_file):
+                if not line.strip():
+                    continue
+                fields = line.strip().replace(",", "\t").split("\t")
+                try:
+                    pairs.append((int(fields[0]), int(fields[1])))
+                except (ValueError, IndexError):
+                    if line_number > 0:
+                        raise Exception("Invalid pair on line {} of {}".format(line_number + 1, self._cfg.pair_file))
+        pairs = np.array(pairs, dtype=np.uint64).reshape(-1, 2)
+        ids = self.f["/input/id"][:]
+        known = np.isin(pairs, ids).all(axis=1)
+        if not known.all():
+            warnings.warn("{} pairs reference ids that are not in the input files and will be skipped".format(
+                np.count_nonzero(~known)))
+        return pairs[known]
+
+    def share_vectors(self):
+        save_prepared_vectors(self.vectors, self._cfg.distance_metric, self.vectors_file, self.block_size)
+        if self.right_vectors_file != self.vectors_file:
+            save_prepared_vectors(self.right_vectors, self._cfg.distance_metric, self.right_vectors_file,
+                                  self.block_size)
+
+    def chunks(self, vectors, size=None):
+        size = size or self.block_size
+        return [(c, min(c + size, len(vectors))) for c in range(0, len(vectors), size)]
 
     def pair_iterator(self):
-        chunks = [(c, min(c + CHUNK_SIZE, len(self.vectors))) for c in range(0, len(self.vectors), CHUNK_SIZE)]
-        for left_index, left in enumerate(chunks):
-            for right in chunks[left_index:]:
-                yield left, right
-            if left_index % 10 == 0:
-                self.announcer("Chunk {:>3d}/{:>3d} completed".format(left_index, len(chunks)))
+        chunks = self.chunks(self.vectors)
+        right_chunks = self.chunks(self.right_vectors)
+        todo = ~self.done
+        if self._cfg.pair_mode == PAIR_MODE.ALL:
+            todo &= np.triu(np.ones_like(todo))
+        if self._cfg.shard is not None:
+            todo &= self.block_shards() == self._cfg.shard
+        for left_index, right_index in zip(*np.nonzero(todo)):
+            if right_chunks[right_index][1] > self.computed:
+                yield chunks[left_index], right_chunks[right_index]
 
-    def convert_to_csv(self):
-        sims = self.ds[:]
+    def pair_batch_iterator(self):
+        indices = np.searchsorted(self.f["/input/id"][:], self.pairs)
+        for offset in range(0, len(indices), self.pair_batch_size):
+            if self.done[offset // self.pair_batch_size, 0]:
+                continue
+            batch = indices[offset:offset + self.pair_batch_size]
+            yield offset, batch[:, 0], batch[:, 1]
+
+    def direct_chunk_level(self):
+        # when every block is exactly one chunk the workers compress it and the chunk is written as it is
+        if (self.ds.chunks == (self.block_size, self.block_size) and self.ds.compression == "gzip" and
+                self.ds.shuffle and not self.ds.fletcher32 and self.ds.scaleoffset is None):
+            return self.ds.compression_opts
+        return None
+
+    def calculate_sims(self):
+        num_blocks = sum(1 for _ in self.pair_iterator())
+        scores = 0
+        level = self.direct_chunk_level()
+        with mp.Pool(self._cfg.num_cores, initializer=sw.init_worker,
+                     initargs=(self.vectors_file, self.right_vectors_file, self.block_size,
+                               self._cfg.precision, level)) as pool:
+            for i, ((lm, lx), (rm, rx), sims) in enumerate(pool.imap_unordered(sw.calculate_sims,
+                                                                               self.pair_iterator())):
+                if level is None:
+                    self.ds[lm:lx, rm:rx] = sims
+                else:
+                    self.ds.id.write_direct_chunk((lm, rm), sims)
+                self.commit(lm // self.block_size, rm // self.block_size)
+                scores += (lx - lm) * (rx - rm)
+                self.events.progress("calculate", i + 1, num_blocks, block=[lm, lx, rm, rx], scores=scores)
+                if (i + 1) % max(num_blocks // 10, 1) == 0:
+                    self.announcer("Block {:>6d}/{:>6d} completed".format(i + 1, num_blocks))
+        return scores
+
+    def calculate_threshold(self):
+        num_blocks = sum(1 for _ in self.pair_iterator())
+        scores = 0
+        if self._cfg.output_format == OUTPUT_FORMAT.CSV:
+            # the edge list is streamed straight to the CSV file and its scores are never stored in between
+            ids = self.f["/input/id"][:]
+            right_ids = self.f["/right/input/id"][:] if self._cfg.pair_mode == PAIR_MODE.CROSS else ids
+            out_file = open_csv('/app/data/output/{}'.format(self._cfg.csv_file), self._cfg.compress)
+            precision = PRECISION.FLOAT32
+        else:
+            precision = self._cfg.precision
+        blocks = ((left, right, self._cfg.threshold) for left, right in self.pair_iterator())
+        try:
+            with mp.Pool(self._cfg.num_cores, initializer=sw.init_worker,
+                         initargs=(self.vectors_file, self.right_vectors_file, self.block_size, precision)) as pool:
+                # blocks are written in order so the edges come out the same on every run
+                for i, ((lm, lx), (rm, rx), rows, cols, sims) in enumerate(pool.imap(sw.calculate_threshold, blocks)):
+                    if self._cfg.output_format == OUTPUT_FORMAT.CSV:
+                        out_file.write(format_rows(ids[rows], right_ids[cols], sims))
+                    else:
+                        for ds, values in ((self.row_ds, rows), (self.col_ds, cols), (self.score_ds, sims)):
+                            ds.resize((self.edges + len(values),))
+                            ds[self.edges:] = values
+                    self.edges += len(sims)
+                    self.commit(lm // self.block_size, rm // self.block_size)
+                    scores += (lx - lm) * (rx - rm)
+                    self.events.progress("calculate", i + 1, num_blocks, block=[lm, lx, rm, rx], scores=scores,
+                                         edges=self.edges)
+                    if (i + 1) % max(num_blocks // 10, 1) == 0:
+                        self.announcer("Block {:>6d}/{:>6d} completed".format(i + 1, num_blocks))
+        finally:
+            if self._cfg.output_format == OUTPUT_FORMAT.CSV:
+                out_file.close()
+        self.announcer("Kept {} pairs scoring at least {}".format(self.edges, self._cfg.threshold))
+        return scores
+
+    def calculate_top_k(self):
+        chunks = [left for i, left in enumerate(self.chunks(self.vectors)) if not self.done[i, 0]]
+        scores = 0
+        with mp.Pool(self._cfg.num_cores, initializer=sw.init_worker,
+                     initargs=(self.vectors_file, self.right_vectors_file, self.block_size,
+                               self._cfg.precision)) as pool:
+            for i, ((lm, lx), index, sims) in enumerate(pool.imap_unordered(sw.calculate_top_k,
+                                                                            [(left, self.k) for left in chunks])):
+                self.index_ds[lm:lx] = index
+                self.score_ds[lm:lx] = sims
+                self.commit(lm // self.block_size)
+                scores += (lx - lm) * len(self.right_vectors)
+                self.events.progress("calculate", i + 1, len(chunks), block=[lm, lx], scores=scores)
+                if (i + 1) % max(len(chunks) // 10, 1) == 0:
+                    self.announcer("Chunk {:>6d}/{:>6d} completed".format(i + 1, len(chunks)))
+        return scores
 
-        with open('/app/data/output/{}'.format(self._cfg.output_file), "w") as out_file:
-            for (left, right), val in zip(combinations(self.f["/input/id"], 2), sims[np.triu_indices_from(sims, k=1)]):
-                out_file.write("{},{},{:0.3f}\n".format(left, right, val))
+    def calculate_condensed(self):
+        strips = [strip for i, strip in enumerate(self.chunks(self.vectors, self.strip_size))
+                  if not self.done[i, 0]]
+        scores = 0
+        with mp.Pool(self._cfg.num_cores, initializer=sw.init_worker,
+                     initargs=(self.vectors_file, self.right_vectors_file, self.block_size,
+                               self._cfg.precision)) as pool:
+            # strips are committed in order so neighbouring writes share partially filled chunks
+            for i, (offset, sims) in enumerate(pool.imap(sw.calculate_condensed, strips)):
+                self.ds[offset:offset + len(sims)] = sims
+                self.commit(strips[i][0] // self.strip_size)
+                scores += len(sims)
+                self.events.progress("calculate", i + 1, len(strips), block=list(strips[i]), scores=scores)
+                if (i + 1) % max(len(strips) // 10, 1) == 0:
+                    self.announcer("Strip {:>6d}/{:>6d} completed".format(i + 1, len(strips)))
+        return scores
+
+    def calculate_pair_sims(self):
+        num_batches = np.count_nonzero(~self.done)
+        scores = 0
+        with mp.Pool(self._cfg.num_cores, initializer=sw.init_worker,
+                     initargs=(self.vectors_file, self.right_vectors_file, self.block_size,
+                               self._cfg.precision)) as pool:
+            for i, (offset, sims) in enumerate(pool.imap_unordered(sw.calculate_pair_sims,
+                                                                   self.pair_batch_iterator())):
+                self.ds[offset:offset + len(sims)] = sims
+                self.commit(offset // self.pair_batch_size)
+                scores += len(sims)
+                self.events.progress("calculate", i + 1, num_batches, block=[offset, offset + len(sims)])
+        self.announcer("Scored {} pairs".format(scores))
+        return scores
+
+    def write_neighbors_csv(self, out_file, ids):
+        if self._cfg.pair_mode == PAIR_MODE.CROSS:
+            neighbor_ids = self.f["/right/input/id"][:]
+        else:
+            neighbor_ids = ids
+        for lm, lx in self.chunks(self.vectors):
+            index = self.index_ds[lm:lx]
+            sims = dequantize(self.score_ds[lm:lx], self.score_ds)
+            out_file.write(format_rows(ids[lm:lx, np.newaxis], neighbor_ids[index], sims))
+
+    def write_pairs_csv(self, out_file):
+        for offset in range(0, len(self.pairs), self.pair_batch_size):
+            pairs = self.pairs[offset:offset + self.pair_batch_size]
+            out_file.write(format_rows(pairs[:, 0], pairs[:, 1],
+                                       dequantize(self.ds[offset:offset + self.pair_batch_size], self.ds)))
+
+    def write_condensed_csv(self, out_file, ids):
+        n = len(ids)
+        for lm, lx in self.chunks(self.vectors, self.strip_size):
+            offset = condensed_offset(lm, n)
+            strip = dequantize(self.ds[offset:condensed_offset(lx, n)], self.ds)
+            for i in range(lm, lx):
+                row = strip[condensed_offset(i, n) - offset:condensed_offset(i + 1, n) - offset]
+                out_file.write(format_rows(ids[i], ids[i + 1:], row))
+
+    def write_matrix_csv(self, out_file, ids):
+        if self._cfg.pair_mode == PAIR_MODE.CROSS:
+            right_ids = self.f["/right/input/id"][:]
+        else:
+            right_ids = ids
+        # read one strip of chunks at a time so that every chunk is decompressed exactly once
+        for lm, lx in self.chunks(self.vectors):
+            if self._cfg.pair_mode == PAIR_MODE.CROSS:
+                strip = dequantize(self.ds[lm:lx], self.ds)
+                for row, left in zip(strip, ids[lm:lx]):
+                    out_file.write(format_rows(left, right_ids, row))
+            else:
+                strip = dequantize(self.ds[lm:lx, lm:], self.ds)
+                for i, (row, left) in enumerate(zip(strip, ids[lm:lx])):
+                    out_file.write(format_rows(left, right_ids[lm + i + 1:], row[i + 1:]))
+
+    def convert_to_csv(self):
+        ids = self.f["/input/id"][:]
+        with open_csv('/app/data/output/{}'.format(self._cfg.csv_file), self._cfg.compress) as out_file:
+            if self._cfg.output_mode == OUTPUT_MODE.TOP_K:
+                self.write_neighbors_csv(out_file, ids)
+            elif self._cfg.pair_mode == PAIR_MODE.LIST:
+                self.write_pairs_csv(out_file)
+            elif self._cfg.storage == SIM_STORAGE.CONDENSED:
+                self.write_condensed_csv(out_file, ids)
+            else:
+                self.write_matrix_csv(out_file, ids)
 
     def main(self):
         self.announcer("Started sim calculation task")
-        for ((lm, lx), (rm, rx)) in self.pair_iterator():
-            self.calculate_sims(lm, lx, rm, rx)
+        with self.events.stage("prepare_vectors", len(self.vectors)):
+            self.share_vectors()
+        self.announcer("Prepared {} vectors for workers".format(self._cfg.distance_metric.name.lower()))
+        with self.events.stage("calculate") as stage:
+            if self._cfg.output_mode == OUTPUT_MODE.TOP_K:
+                stage.items = self.calculate_top_k()
+            elif self._cfg.output_mode == OUTPUT_MODE.THRESHOLD:
+                stage.items = self.calculate_threshold()
+                stage.fields["edges"] = self.edges
+            elif self._cfg.pair_mode == PAIR_MODE.LIST:
+                stage.items = self.calculate_pair_sims()
+            elif self._cfg.storage == SIM_STORAGE.CONDENSED:
+                stage.items = self.calculate_condensed()
+            else:
+                stage.items = self.calculate_sims()
+        self.finish()
+
+    def finish(self):
+        self.save_checkpoint()
+        if self._cfg.incremental:
+            self.vectors.attrs["unchanged"] = len(self.vectors)
         self.announcer("finished calculating sims")
+        if self._cfg.shard is not None:
+            self.out.close()
+            self.announcer("finished shard {} of {}".format(self._cfg.shard, self._cfg.shards))
+            return
         if self._cfg.output_format == OUTPUT_FORMAT.CSV:
-            self.announcer("converting to CSV")
-            self.convert_to_csv()
-            self.announcer("finished CSV conversion")
+            if self._cfg.output_mode != OUTPUT_MODE.THRESHOLD:
+                self.announcer("converting to CSV")
+                with self.events.stage("convert_to_csv", len(self.vectors)):
+                    self.convert_to_csv()
+                self.announcer("finished CSV conversion")
+            self.f.close()
+            # the spaces calculated after this one still read their vectors from the intermediate file
+            if self._cfg.last_space:
+                os.remove(intermediate_file(self._cfg.output_file))
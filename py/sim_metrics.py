@@ -0,0 +1,30 @@
+import numpy as np
+
+from py.utils import DISTANCE_METRIC
+
+
+def condensed_offset(i, n):
+    # position of (i, i + 1) in the condensed vector; row i holds n - i - 1 values
+    return i * n - i * (i + 1) // 2
+
+
+def condensed_index(i, j, n):
+    return condensed_offset(i, n) + j - i - 1
+
+
+def prepare_vectors(vectors, distance_metric):
+    # once rows are centred (r) and scaled to unit length, both metrics are a plain dot product
+    vectors = np.array(vectors, dtype=np.float32)
+    if distance_metric == DISTANCE_METRIC.R:
+        vectors -= vectors.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.divide(vectors, norms, out=vectors, where=norms > 0)
+    return vectors
+
+
+def save_prepared_vectors(vectors, distance_metric, file_name, block_size):
+    prepared = np.lib.format.open_memmap(file_name, mode='w+', dtype=np.float32, shape=vectors.shape)
+    for start in range(0, len(vectors), block_size):
+        prepared[start:start + block_size] = prepare_vectors(vectors[start:start + block_size], distance_metric)
+    prepared.flush()
+    del prepared
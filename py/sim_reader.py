@@ -0,0 +1,90 @@
+import h5py
+import numpy as np
+
+from py.precision import dequantize
+from py.sim_metrics import condensed_index, prepare_vectors
+from py.utils import *
+
+
+class SimReader(object):
+    def __init__(self, file_name, ds_name):
+        self.f = h5py.File(file_name, 'r')
+        self.ds = self.f['/sim/{}'.format(ds_name)]
+        self.vectors = self.f['/vectors/{}'.format(ds_name)]
+        self.pair_mode = PAIR_MODE[self.ds.attrs.get("pairs", "all").upper()]
+        if self.pair_mode == PAIR_MODE.LIST:
+            raise Exception("Similarities calculated from a pair list can not be read by id")
+        self.condensed = self.ds.attrs.get("storage") == "condensed"
+        self.distance_metric = DISTANCE_METRIC[self.ds.attrs.get("distance_metric", "cosine").upper()]
+        self.ids = self.f['/input/id'][:]
+        if self.pair_mode == PAIR_MODE.CROSS:
+            self.right_ids = self.f['/right/input/id'][:]
+        else:
+            self.right_ids = self.ids
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def _positions(ids, text_ids):
+        text_ids = np.asarray(text_ids, dtype=ids.dtype)
+        positions = np.searchsorted(ids, text_ids)
+        found = (positions < len(ids)) & (ids[np.minimum(positions, len(ids) - 1)] == text_ids)
+        if not np.all(found):
+            raise KeyError("Unknown text ids: {}".format(np.atleast_1d(text_ids)[~np.atleast_1d(found)]))
+        return positions
+
+    def _self_sims(self, positions):
+        unique = np.unique(positions)
+        vectors = prepare_vectors(self.vectors[unique], self.distance_metric)
+        return dict(zip(unique, np.einsum('ij,ij->i', vectors, vectors)))
+
+    def _read_full(self, rows, cols):
+        # h5py only accepts increasing indices along one axis, so read along whichever axis needs fewer reads
+        sims = np.empty(len(rows), dtype=np.float32)
+        if len(np.unique(cols)) < len(np.unique(rows)):
+            for col in np.unique(cols):
+                mask = cols == col
+                unique, inverse = np.unique(rows[mask], return_inverse=True)
+                sims[mask] = dequantize(self.ds[unique, col], self.ds)[inverse]
+        else:
+            for row in np.unique(rows):
+                mask = rows == row
+                unique, inverse = np.unique(cols[mask], return_inverse=True)
+                sims[mask] = dequantize(self.ds[row, unique], self.ds)[inverse]
+        return sims
+
+    def _read_upper(self, rows, cols):
+        if not self.condensed:
+            return self._read_full(rows, cols)
+        flat = condensed_index(rows.astype(np.int64), cols.astype(np.int64), len(self.ids))
+        unique, inverse = np.unique(flat, return_inverse=True)
+        return dequantize(self.ds[unique], self.ds)[inverse] if len(unique) else np.empty(0, dtype=np.float32)
+
+    def block(self, left_ids, right_ids):
+        left = self._positions(self.ids, left_ids)
+        right = self._positions(self.right_ids, right_ids)
+        rows, cols = np.meshgrid(left, right, indexing='ij')
+        rows, cols = rows.ravel(), cols.ravel()
+        if self.pair_mode == PAIR_MODE.CROSS:
+            return self._read_full(rows, cols).reshape(len(left), len(right))
+        sims = np.empty(len(rows), dtype=np.float32)
+        lower, upper = np.minimum(rows, cols), np.maximum(rows, cols)
+        off_diagonal = lower != upper
+        sims[off_diagonal] = self._read_upper(lower[off_diagonal], upper[off_diagonal])
+        if not np.all(off_diagonal):
+            self_sims = self._self_sims(lower[~off_diagonal])
+            sims[~off_diagonal] = [self_sims[i] for i in lower[~off_diagonal]]
+        return sims.reshape(len(left), len(right))
+
+    def row(self, text_id):
+        return self.block([text_id], self.right_ids)[0]
+
+    def pair(self, left_id, right_id):
+        return self.block([left_id], [right_id])[0, 0]
@@ -0,0 +1,114 @@
+import zlib
+
+import numpy as np
+
+from py.precision import quantize
+from py.sim_metrics import condensed_offset
+
+
+class BlockCalculator(object):
+
+    def __init__(self, vectors_file, right_vectors_file, block_size, precision, compression_level=None):
+        self.vectors = np.load(vectors_file, mmap_mode='r')
+        self.right_vectors = np.load(right_vectors_file, mmap_mode='r')
+        self.symmetric = vectors_file == right_vectors_file
+        self.block_size = block_size
+        self.precision = precision
+        self.compression_level = compression_level
+
+    def block_sims(self, left, right):
+        left_min, left_max = left
+        right_min, right_max = right
+        return np.dot(self.vectors[left_min:left_max], self.right_vectors[right_min:right_max].T)
+
+    def calculate_sims(self, left, right):
+        sims = self.block_sims(left, right)
+        if self.symmetric and left[0] == right[0]:
+            sims = np.triu(sims)
+        # scores are stored at the requested precision before they are sent back, which also shrinks the transfer
+        sims = quantize(sims, self.precision)
+        if self.compression_level is not None:
+            sims = self.compress_chunk(sims)
+        return left, right, sims
+
+    def compress_chunk(self, sims):
+        # the block becomes one whole chunk of the dataset, run through the same shuffle and gzip filters h5py uses,
+        # so the parent only has to write the bytes
+        chunk = np.zeros((self.block_size, self.block_size), dtype=sims.dtype)
+        chunk[:sims.shape[0], :sims.shape[1]] = sims
+        shuffled = chunk.view(np.uint8).reshape(-1, chunk.dtype.itemsize).T.tobytes()
+        return zlib.compress(shuffled, self.compression_level)
+
+    def calculate_threshold(self, left, right, threshold):
+        # only the pairs that pass are sent back, as positions in the full matrix
+        sims = self.block_sims(left, right)
+        keep = sims >= threshold
+        if self.symmetric and left[0] == right[0]:
+            keep &= np.arange(sims.shape[1]) > np.arange(sims.shape[0])[:, np.newaxis]
+        rows, cols = np.nonzero(keep)
+        return left, right, rows + left[0], cols + right[0], quantize(sims[rows, cols], self.precision)
+
+    def calculate_top_k(self, left, k):
+        left_min, left_max = left
+        rows = np.arange(left_max - left_min)[:, np.newaxis]
+        best_index = np.empty((left_max - left_min, 0), dtype=np.int64)
+        best_sims = np.empty((left_max - left_min, 0), dtype=np.float32)
+        for right_min in range(0, len(self.right_vectors), self.block_size):
+            right_max = min(right_min + self.block_size, len(self.right_vectors))
+            sims = self.block_sims(left, (right_min, right_max))
+            if self.symmetric:
+                # a text is never its own neighbour
+                own = np.arange(max(left_min, right_min), min(left_max, right_max))
+                sims[own - left_min, own - right_min] = -np.inf
+            candidate_index = np.hstack([best_index,
+                                         np.broadcast_to(np.arange(right_min, right_max), sims.shape)])
+            candidate_sims = np.hstack([best_sims, sims])
+            if candidate_sims.shape[1] > k:
+                keep = np.argpartition(-candidate_sims, k - 1, axis=1)[:, :k]
+                candidate_index = candidate_index[rows, keep]
+                candidate_sims = candidate_sims[rows, keep]
+            best_index, best_sims = candidate_index, candidate_sims
+        order = np.argsort(-best_sims, axis=1, kind='stable')
+        return left, best_index[rows, order], quantize(best_sims[rows, order], self.precision)
+
+    def calculate_condensed(self, left):
+        left_min, left_max = left
+        sims = self.block_sims(left, (left_min, len(self.right_vectors)))
+        upper = np.arange(sims.shape[1]) > np.arange(sims.shape[0])[:, np.newaxis]
+        return condensed_offset(left_min, len(self.vectors)), quantize(sims[upper], self.precision)
+
+    def calculate_pair_sims(self, offset, left_index, right_index):
+        sims = np.einsum('ij,ij->i', self.vectors[left_index], self.right_vectors[right_index])
+        return offset, quantize(sims, self.precision)
+
+bc: BlockCalculator
+
+
+def init_worker(vectors_file, right_vectors_file, block_size, precision, compression_level=None):
+    global bc
+    bc = BlockCalculator(vectors_file, right_vectors_file, block_size, precision, compression_level)
+
+
+def calculate_sims(block):
+    global bc
+    return bc.calculate_sims(*block)
+
+
+def calculate_pair_sims(batch):
+    global bc
+    return bc.calculate_pair_sims(*batch)
+
+
+def calculate_threshold(block):
+    global bc
+    return bc.calculate_threshold(*block)
+
+
+def calculate_top_k(task):
+    global bc
+    return bc.calculate_top_k(*task)
+
+
+def calculate_condensed(left):
+    global bc
+    return bc.calculate_condensed(left)
@@ -0,0 +1,17 @@
+from functools import partial
+
+from py.batch_projector import compile_space
+from py.configurator import Compile
+from py.utils import *
+
+
+class Compiler(object):
+
+    def __init__(self, config: Compile, start_time):
+        self._cfg = config
+        self.announcer = partial(announcer, process="Compiler", start=start_time)
+
+    def main(self):
+        self.announcer("Started")
+        space_dir = compile_space(self._cfg.space_name)
+        self.announcer("Compiled space into {}".format(space_dir))
@@ -1,19 +1,39 @@
 import os
 import multiprocessing as mp
+import shutil
+import time
 from functools import partial
-from gensim.corpora import Dictionary
+from glob import glob
+from itertools import islice
+import numpy as np
+import yaml
+from gensim.corpora import Dictionary, MmCorpus
+from gensim.matutils import corpus2csc
 from gensim.models import LogEntropyModel, LsiModel
-from py.document_cleaner import init_worker, clean_document
+from py.batch_projector import compile_space
+from py.randomized_svd import randomized_svd
+import py.corpus_worker as cw
 from py.configurator import Create
+from py.events import EventLog
 from py.utils import *
 
 
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
 class Creator(object):
 
     def __init__(self, config: Create, start_time):
         self._cfg = config
         self.documents = list()
+        self.decomposition = dict()
         self.announcer = partial(announcer, process="Creator", start=start_time)
+        self.events = EventLog("Creator", config, "/app/data/spaces/{}/profile".format(config.space_name))
 
     def load_documents(self):
         self.documents = []
@@ -27,10 +47,59 @@ class Creator(object):
                     new_documents = in_file.readlines()
                 self.documents.extend(new_documents)
 
-    def create_dictionary(self, clean_documents):
+    def iter_documents(self):
+        for paragraph_file in self._cfg.source_files:
+            with open("/app/data/%s" % paragraph_file) as in_file:
+                if self._cfg.headers:
+                    in_file.readline()
+                for line in in_file:
+                    if self._cfg.numbered:
+                        yield line[:-1].split("\t")[1]
+                    else:
+                        yield line
+
+    def pool(self, token2id=None):
+        return mp.Pool(self._cfg.num_cores, initializer=cw.init_worker, initargs=(self._cfg.space_settings, token2id))
+
+    @property
+    def shard_size(self):
+        # about four shards per core out of every chunk of documents
+        return max(1, self._cfg.chunk_size // (4 * self._cfg.num_cores))
+
+    def count_terms(self, pool, documents, out_file=None):
+        # workers clean and count their own shards; only the per shard tables are merged here
+        counts = {}
+        clean_documents = []
+        num_docs, num_pos = 0, 0
+        for shard, shard_counts, shard_pos in pool.imap(cw.count_terms, chunked(documents, self.shard_size)):
+            for token, (cf, df) in shard_counts.items():
+                try:
+                    counts[token][0] += cf
+                    counts[token][1] += df
+                except KeyError:
+                    counts[token] = [cf, df]
+            num_docs += len(shard)
+            num_pos += shard_pos
+            if out_file is None:
+                clean_documents.extend(shard)
+            else:
+                out_file.writelines(" ".join(document) + "\n" for document in shard)
+                if num_docs % self._cfg.chunk_size < len(shard):
+                    self.announcer(msg="Cleaned {} Documents".format(num_docs))
+        return clean_documents, self.create_dictionary(counts, num_docs, num_pos)
+
+    def create_dictionary(self, counts, num_docs, num_pos):
+        # shards are merged in order, so ids come out exactly as Dictionary.add_documents would assign them
         dictionary = Dictionary()
-        dictionary.add_documents(clean_documents, prune_at=None)
-        self.announcer(msg="Loaded Dictionary")
+        dictionary.token2id = {token: token_id for token_id, token in enumerate(counts)}
+        dictionary.cfs = {token_id: cf for token_id, (cf, _) in enumerate(counts.values())}
+        dictionary.dfs = {token_id: df for token_id, (_, df) in enumerate(counts.values())}
+        dictionary.num_docs = num_docs
+        dictionary.num_pos = num_pos
+        dictionary.num_nnz = sum(dictionary.dfs.values())
+        return dictionary
+
+    def filter_dictionary(self, dictionary):
         if self._cfg.space_settings.remove_singletons:
             singleton_oids = [tokenid for tokenid, docfreq in dictionary.dfs.items() if docfreq == 1]
             dictionary.filter_tokens(singleton_oids)
@@ -38,38 +107,126 @@ class Creator(object):
         self.announcer(msg="Filtered Dictionary")
         return dictionary
 
-    def create_space(self, clean_documents):
-        dictionary = self.create_dictionary(clean_documents)
-        corpus = [dictionary.doc2bow(paragraph) for paragraph in clean_documents]
+    def create_space(self):
+        with self.events.stage("clean", len(self.documents)), self.pool() as pool:
+            clean_documents, dictionary = self.count_terms(pool, self.documents)
+        self.announcer(msg="Cleaned Documents")
+        with self.events.stage("filter_dictionary", len(dictionary)):
+            self.filter_dictionary(dictionary)
+        with self.events.stage("corpus", len(clean_documents)), self.pool(dictionary.token2id) as pool:
+            corpus = [bow for shard in pool.imap(cw.bag_of_words, chunked(clean_documents, self.shard_size))
+                      for bow in shard]
+        self.announcer(msg="Created Corpus")
+        return self.train_models(dictionary, corpus)
+
+    def create_streamed_space(self):
+        # only a few chunks of raw and cleaned text are held at a time, the cleaned documents go to disk
+        clean_file = "{}/clean_documents.txt".format(self._cfg.temp_dir)
+        corpus_file = "{}/corpus.mm".format(self._cfg.temp_dir)
+        with self.events.stage("clean") as stage, self.pool() as pool, open(clean_file, "w") as out_file:
+            _, dictionary = self.count_terms(pool, self.iter_documents(), out_file)
+            stage.items = dictionary.num_docs
+        self.announcer(msg="Cleaned Documents")
+        with self.events.stage("filter_dictionary", len(dictionary)):
+            self.filter_dictionary(dictionary)
+        with self.events.stage("corpus", dictionary.num_docs), self.pool(dictionary.token2id) as pool, \
+                open(clean_file) as in_file:
+            MmCorpus.serialize(corpus_file, (bow for shard in pool.imap(cw.bag_of_words_from_lines,
+                                                                        chunked(in_file, self.shard_size))
+                                             for bow in shard))
+        os.remove(clean_file)
         self.announcer(msg="Created Corpus")
-        log_ent_model = LogEntropyModel(corpus,
-                                        id2word=dictionary)
+        # the serialized corpus is streamed from disk again on every pass the models make over it
+        return self.train_models(dictionary, MmCorpus(corpus_file))
+
+    def train_models(self, dictionary, corpus):
+        with self.events.stage("log_entropy", dictionary.num_docs):
+            log_ent_model = LogEntropyModel(corpus,
+                                            id2word=dictionary)
         self.announcer(msg="Made Log Entropy Model")
         log_ent_corpus = log_ent_model[corpus]
         self.announcer(msg="Made Log Entropy Corpus")
-        lsa_model = LsiModel(log_ent_corpus,
-                             id2word=dictionary,
-                             num_topics=self._cfg.space_settings.dimensions,
-                             distributed=False)
+        with self.events.stage("decomposition", dictionary.num_docs) as stage:
+            if self._cfg.decomposition == DECOMPOSITION.RANDOMIZED:
+                lsa_model, total = self.randomized_lsi(dictionary, log_ent_corpus)
+            else:
+                lsa_model = LsiModel(log_ent_corpus,
+                                     id2word=dictionary,
+                                     num_topics=self._cfg.space_settings.dimensions,
+                                     chunksize=self._cfg.chunk_size,
+                                     distributed=False)
+                # log entropy rows are unit length, so this skips a pass over the corpus just to sum their squares;
+                # documents that filtering left empty make it a slight overestimate
+                total = dictionary.num_docs
+            self.record_decomposition(lsa_model.projection.s, total, time.time() - stage.start)
         self.announcer(msg="Made LSA Model")
-        return dictionary, lsa_model
+        return dictionary, log_ent_model, lsa_model
+
+    def randomized_lsi(self, dictionary, log_ent_corpus):
+        matrix = corpus2csc(log_ent_corpus, num_terms=len(dictionary), dtype=np.float32).tocsr()
+        self.announcer(msg="Made Log Entropy Matrix")
+        u, s = randomized_svd(matrix,
+                              self._cfg.space_settings.dimensions,
+                              self._cfg.oversamples,
+                              self._cfg.power_iters)
+        # an untrained model with the decomposition filled in saves in the layout everything else reads
+        lsa_model = LsiModel(id2word=dictionary, num_topics=len(s))
+        lsa_model.projection.u = u
+        lsa_model.projection.s = s
+        return lsa_model, float(matrix.multiply(matrix).sum())
+
+    def record_decomposition(self, s, total, seconds):
+        explained = float(np.sum(np.square(s, dtype=np.float64)) / total) if total else 0.0
+        self.decomposition = {
+            "backend": self._cfg.decomposition.name.lower(),
+            "dimensions": len(s),
+            "seconds": round(seconds, 3),
+            "explained": explained,
+            "relative_error": float(np.sqrt(max(1 - explained, 0)))
+        }
+        if self._cfg.decomposition == DECOMPOSITION.RANDOMIZED:
+            self.decomposition["oversamples"] = self._cfg.oversamples
+            self.decomposition["power_iters"] = self._cfg.power_iters
+        self.announcer(msg="Decomposed in {:.1f}s, {:.1%} explained".format(seconds, explained))
+
+    def save_decomposition(self):
+        with open('/app/data/spaces/%s/decomposition.yml' % self._cfg.space_name, "w") as out_file:
+            yaml.dump(self.decomposition, out_file, default_flow_style=False)
 
     def main(self):
         self.announcer(msg="Started")
-        self.load_documents()
-        self.announcer(msg="Loaded Documents")
-        with mp.Pool(mp.cpu_count()-1, initializer=init_worker, initargs=(self._cfg.space_settings,)) as pool:
-            clean_documents = [l for l in pool.map_async(func=clean_document, iterable=self.documents).get()]
-        self.announcer(msg="Cleaned Documents")
-        dictionary, model = self.create_space(clean_documents)
-        self.announcer(msg="Created Space")
         try:
             os.makedirs('/app/data/spaces/%s' % self._cfg.space_name)
         except FileExistsError:
             pass
+        if self._cfg.streaming:
+            dictionary, log_ent_model, model = self.create_streamed_space()
+        else:
+            with self.events.stage("load_documents") as stage:
+                self.load_documents()
+                stage.items = len(self.documents)
+            self.announcer(msg="Loaded Documents")
+            dictionary, log_ent_model, model = self.create_space()
+        self.announcer(msg="Created Space")
+        with self.events.stage("save", len(dictionary)):
+            self.save_space(dictionary, log_ent_model, model)
+        with self.events.stage("compile", len(dictionary)):
+            compile_space(self._cfg.space_name)
+        self.announcer(msg="Compiled Space")
+
+    def save_space(self, dictionary, log_ent_model, model):
         dictionary.save('/app/data/spaces/%s/dictionary' % self._cfg.space_name)
         self.announcer(msg="Saved Dictionary")
+        log_ent_model.save('/app/data/spaces/%s/log_entropy' % self._cfg.space_name)
+        self.announcer(msg="Saved Log Entropy Model")
         model.save('/app/data/spaces/%s/lsi' % self._cfg.space_name)
         self.announcer(msg="Saved LSA Model")
+        # a rotation of the previous model would otherwise be reused by rotate_space
+        for rotated in glob('/app/data/spaces/%s/lsi_rotated*' % self._cfg.space_name):
+            if os.path.isdir(rotated):
+                shutil.rmtree(rotated)
+            else:
+                os.remove(rotated)
+        self.save_decomposition()
         self._cfg.space_settings.save()
         self.announcer(msg="Saved Settings")
@@ -2,10 +2,23 @@ import subprocess
 from datetime import datetime
 from enum import Enum
 
-TASK_TYPE = Enum('TASK_TYPE', 'CREATE PROJECT CALCULATE ROTATE')
+TASK_TYPE = Enum('TASK_TYPE', 'CREATE PROJECT CALCULATE ROTATE COMPILE SERVE INDEX QUERY MERGE')
 PAIR_MODE = Enum('PAIR_MODE', 'ALL CROSS LIST')
 OUTPUT_FORMAT = Enum('OUTPUT_FORMAT', 'H5 CSV')
 DISTANCE_METRIC = Enum('DISTANCE_METRIC', 'COSINE R')
+OUTPUT_MODE = Enum('OUTPUT_MODE', 'MATRIX TOP_K THRESHOLD')
+SIM_STORAGE = Enum('SIM_STORAGE', 'FULL CONDENSED')
+DECOMPOSITION = Enum('DECOMPOSITION', 'GENSIM RANDOMIZED')
+PRECISION = Enum('PRECISION', 'FLOAT32 FLOAT16 INT16 INT8')
+
+
+def intermediate_file(output_file):
+    # kept outside the temp directory, which is removed even when a task fails, so that CSV runs can resume
+    return "/app/data/output/{}.partial.h5".format(output_file)
+
+
+def shard_file(file_name, shard, shards):
+    return "{}.shard-{}-of-{}.h5".format(file_name, shard, shards)
 
 
 def run_cmd(cmd, raw=False):
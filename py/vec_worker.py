@@ -1,25 +1,26 @@
-import numpy as np
+from py.batch_projector import BatchProjector
+from py.document_cleaner import DocumentCleaner
 
 
 class Vectorizer(object):
 
-    def __init__(self, dictionary, model):
-        self.dictionary = dictionary
-        self.model = model
+    def __init__(self, space_settings, space_dirs, scaled):
+        self.cleaner = DocumentCleaner(space_settings)
+        self.projectors = [BatchProjector.load(space_dir, scaled) for space_dir in space_dirs]
 
-    def vectorize(self, key, document):
-        bow = self.dictionary.doc2bow(document)
-        ms = self.model[bow]
-        return key, np.array([n[1] for n in ms], dtype=np.float32)
+    def vectorize(self, offset, documents):
+        # every space that cleans texts the same way folds in the same cleaned batch
+        documents = self.cleaner.clean_documents(documents)
+        return offset, [projector.project(documents) for projector in self.projectors]
 
 v: Vectorizer
 
 
-def init_worker(d, m):
+def init_worker(space_settings, space_dirs, scaled):
     global v
-    v = Vectorizer(d, m)
+    v = Vectorizer(space_settings, space_dirs, scaled)
 
 
-def vectorize(key, document):
+def vectorize(batch):
     global v
-    return v.vectorize(key, document)
\ No newline at end of file
+    return v.vectorize(*batch)
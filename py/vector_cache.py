@@ -0,0 +1,79 @@
+import os
+import shutil
+from hashlib import blake2b
+
+import h5py
+import numpy as np
+
+from py.batch_projector import token_hash
+
+
+def text_hashes(texts):
+    return np.fromiter((token_hash(t) for t in texts), dtype=np.uint64, count=len(texts))
+
+
+def space_fingerprint(space_settings, projector, scaled):
+    # anything that changes how a text is cleaned or projected has to change the key
+    fingerprint = blake2b(digest_size=16)
+    fingerprint.update(repr((space_settings.case_sensitive,
+                             space_settings.remove_punctuation,
+                             space_settings.remove_numbers,
+                             space_settings.stem,
+                             space_settings.stopwords,
+                             scaled)).encode('utf-8'))
+    fingerprint.update(np.ascontiguousarray(projector.s).tobytes())
+    fingerprint.update(np.ascontiguousarray(projector.u[:1]).tobytes())
+    return fingerprint.hexdigest()
+
+
+class VectorCache(object):
+    # projected vectors addressed by the hash of the raw text, one file per space and cleaning configuration
+
+    def __init__(self, space_settings, projector, scaled):
+        self.fingerprint = space_fingerprint(space_settings, projector, scaled)
+        self.file_name = "/app/data/cache/{}/{}.h5".format(space_settings.space_name, self.fingerprint)
+        self.dimensions = projector.dimensions
+
+    def lookup(self, hashes):
+        found = np.zeros(len(hashes), dtype=bool)
+        vectors = np.zeros((len(hashes), self.dimensions), dtype=np.float32)
+        if not os.path.isfile(self.file_name):
+            return found, vectors
+        with h5py.File(self.file_name, 'r') as f:
+            cached = f["hash"][:]
+            if not len(cached):
+                return found, vectors
+            order = np.argsort(cached)
+            positions = np.minimum(np.searchsorted(cached[order], hashes), len(cached) - 1)
+            found = cached[order[positions]] == hashes
+            # h5py wants increasing indices
+            rows, inverse = np.unique(order[positions[found]], return_inverse=True)
+            if len(rows):
+                vectors[found] = f["vectors"][rows][inverse]
+        return found, vectors
+
+    def add(self, hashes, vectors):
+        hashes, first = np.unique(hashes, return_index=True)
+        if not len(hashes):
+            return
+        os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+        with h5py.File(self.file_name, 'a') as f:
+            if "hash" not in f:
+                f.create_dataset("hash", dtype='u8', shape=(0,), maxshape=(None,), chunks=(65536,))
+                f.create_dataset("vectors",
+                                 dtype=np.float32,
+                                 shape=(0, self.dimensions),
+                                 maxshape=(None, self.dimensions),
+                                 chunks=(1000, self.dimensions),
+                                 compression="gzip",
+                                 compression_opts=9,
+                                 shuffle=True)
+            new = ~np.isin(hashes, f["hash"][:])
+            start = len(f["hash"])
+            end = start + np.count_nonzero(new)
+            if end > start:
+                f["hash"].resize((end,))
+                f["hash"][start:] = hashes[new]
+                f["vectors"].resize((end, self.dimensions))
+                f["vectors"][start:] = vectors[first[new]]
+        shutil.chown(self.file_name, user=1000)